@@ -0,0 +1,270 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from time import perf_counter
+
+import rdkit
+
+from rdchiral.initialization import rdchiralReaction, rdchiralReactants
+from rdchiral.main import rdchiralRun
+from rdchiral.clean import combine_enantiomers_into_racemic
+
+'''
+This file contains a reproducible benchmark suite for rdchiral.
+
+Every template in the test cases (test/test_rdchiral_cases.json) is applied to
+the first `n_smiles` molecules of rdchiral/test/test_smiles_from_50k_uspto.txt,
+plus the reactants of the test cases themselves. The suite measures
+
+    reactant_init        rdchiralReactants for each molecule
+    reaction_init        rdchiralReaction for each template
+    run                  rdchiralRun for every (template, molecule) pair
+    combine_enantiomers  combine_enantiomers_into_racemic on the outcomes of every pair with outcomes
+    memory               peak Python heap while initializing and running (tracemalloc)
+
+Each timed benchmark runs `repeat` times. Every repetition's seconds are kept, so
+two result files can be compared statistically, not just by their best time.
+The results are a JSON-serializable dict that also records the RDKit and Python
+versions.
+
+Usage:
+
+    python -m rdchiral.benchmarks.benchmark --n-smiles 1000 --repeat 3 -o results.json
+'''
+
+_here = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SMILES_PATH = os.path.join(os.path.dirname(_here), 'test', 'test_smiles_from_50k_uspto.txt')
+DEFAULT_CASES_PATH = os.path.join(os.path.dirname(os.path.dirname(_here)), 'test', 'test_rdchiral_cases.json')
+
+def load_smiles(path=DEFAULT_SMILES_PATH, n_smiles=None):
+    '''Read one SMILES per line
+
+    Args:
+        path (str): SMILES file
+        n_smiles (int, optional): Only read this many molecules
+
+    Returns:
+        list: SMILES strings
+    '''
+    smiles = []
+    with open(path, 'r') as fid:
+        for line in fid:
+            line = line.strip()
+            if not line:
+                continue
+            if n_smiles is not None and len(smiles) >= n_smiles:
+                break
+            smiles.append(line)
+    return smiles
+
+def load_cases(path=DEFAULT_CASES_PATH):
+    '''Read test cases, a list of dicts with keys 'smarts', 'smiles' and 'expected' '''
+    with open(path, 'r') as fid:
+        return json.load(fid)
+
+def _summarize(samples, n, unit):
+    '''Summary of repeated timings of `n` items'''
+    best = min(samples)
+    return {
+        'samples': samples,
+        'seconds': best,
+        'count': n,
+        unit + '_per_second': n / best if best > 0 else None,
+        'us_per_' + unit[:-1]: 1e6 * best / n if n else None,
+    }
+
+def bench_reactant_init(smiles, repeat=3):
+    '''Time rdchiralReactants
+
+    Args:
+        smiles (list): Reactant SMILES strings
+        repeat (int): Number of repetitions
+
+    Returns:
+        (dict, list): Timing summary and the initialized reactants of the last repetition
+    '''
+    samples = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        reactants = [rdchiralReactants(smi) for smi in smiles]
+        samples.append(perf_counter() - t0)
+    return _summarize(samples, len(smiles), 'molecules'), reactants
+
+def bench_reaction_init(smarts, repeat=3):
+    '''Time rdchiralReaction
+
+    Args:
+        smarts (list): Reaction SMARTS strings
+        repeat (int): Number of repetitions
+
+    Returns:
+        (dict, list): Timing summary and the initialized reactions of the last repetition
+    '''
+    samples = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        rxns = [rdchiralReaction(sma) for sma in smarts]
+        samples.append(perf_counter() - t0)
+    return _summarize(samples, len(smarts), 'templates'), rxns
+
+def bench_run(pairs, repeat=3):
+    '''Time rdchiralRun over (rxn, reactants) pairs, without combining enantiomers
+
+    Args:
+        pairs (list): (rdchiralReaction, rdchiralReactants) tuples
+        repeat (int): Number of repetitions
+
+    Returns:
+        (dict, list): Timing summary and the outcomes of each pair (last repetition)
+    '''
+    samples = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        outcomes = [rdchiralRun(rxn, reactants, combine_enantiomers=False) for (rxn, reactants) in pairs]
+        samples.append(perf_counter() - t0)
+    result = _summarize(samples, len(pairs), 'pairs')
+    n_outcomes = sum(len(o) for o in outcomes)
+    result['outcomes'] = n_outcomes
+    result['outcomes_per_second'] = n_outcomes / result['seconds'] if result['seconds'] > 0 else None
+    return result, outcomes
+
+def bench_combine_enantiomers(outcome_lists, repeat=3):
+    '''Time combine_enantiomers_into_racemic on the outcomes of each pair that had any
+
+    Args:
+        outcome_lists (list): Outcome SMILES lists, e.g., from `bench_run`
+        repeat (int): Number of repetitions
+
+    Returns:
+        dict: Timing summary, per non-empty set of outcomes
+    '''
+    outcome_sets = [set(o) for o in outcome_lists if o]
+    samples = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        for outcomes in outcome_sets:
+            combine_enantiomers_into_racemic(set(outcomes))
+        samples.append(perf_counter() - t0)
+    return _summarize(samples, len(outcome_sets), 'sets')
+
+def bench_memory(smiles, smarts):
+    '''Peak Python heap while initializing templates and reactants and running all pairs
+
+    Note: tracemalloc only sees allocations made through Python, not RDKit's
+    own C++ allocations, so this tracks rdchiral's overhead rather than the
+    total footprint. The maximum resident set size of the process is reported
+    as well where the `resource` module is available.
+
+    Args:
+        smiles (list): Reactant SMILES strings
+        smarts (list): Reaction SMARTS strings
+
+    Returns:
+        dict: Peak traced memory in bytes ('peak_bytes') and 'max_rss_kb' (or None)
+    '''
+    tracemalloc.start()
+    try:
+        rxns = [rdchiralReaction(sma) for sma in smarts]
+        reactants = [rdchiralReactants(smi) for smi in smiles]
+        for rxn in rxns:
+            for r in reactants:
+                rdchiralRun(rxn, r)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    try:
+        import resource
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        max_rss_kb = None
+    return {'peak_bytes': peak, 'max_rss_kb': max_rss_kb}
+
+def run_benchmarks(smiles_path=DEFAULT_SMILES_PATH, cases_path=DEFAULT_CASES_PATH, n_smiles=1000,
+        repeat=3, memory=True, memory_n_smiles=200):
+    '''Run the full benchmark suite
+
+    Args:
+        smiles_path (str): SMILES file, one molecule per line
+        cases_path (str): Test cases JSON file
+        n_smiles (int): Number of molecules from `smiles_path` to use
+        repeat (int): Number of repetitions of each timed benchmark
+        memory (bool): Whether to measure peak memory (in a separate, slower pass)
+        memory_n_smiles (int): Number of molecules used for the memory pass
+
+    Returns:
+        dict: JSON-serializable results, keys 'meta' and 'benchmarks'
+    '''
+    cases = load_cases(cases_path)
+    smiles = load_smiles(smiles_path, n_smiles) + [case['smiles'] for case in cases]
+    smarts = [case['smarts'] for case in cases]
+
+    benchmarks = {}
+    benchmarks['reactant_init'], reactants = bench_reactant_init(smiles, repeat)
+    benchmarks['reaction_init'], rxns = bench_reaction_init(smarts, repeat)
+    pairs = [(rxn, r) for rxn in rxns for r in reactants]
+    benchmarks['run'], outcomes = bench_run(pairs, repeat)
+    benchmarks['combine_enantiomers'] = bench_combine_enantiomers(outcomes, repeat)
+    if memory:
+        benchmarks['memory'] = bench_memory(smiles[:memory_n_smiles], smarts)
+
+    return {
+        'meta': {
+            'rdkit_version': rdkit.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'smiles_path': os.path.basename(smiles_path),
+            'cases_path': os.path.basename(cases_path),
+            'n_smiles': len(smiles),
+            'n_templates': len(smarts),
+            'repeat': repeat,
+        },
+        'benchmarks': benchmarks,
+    }
+
+def format_results(results):
+    '''Human-readable summary of `run_benchmarks` results'''
+    meta = results['meta']
+    lines = ['rdchiral benchmarks: {} molecules x {} templates, RDKit {}, Python {}'.format(
+        meta['n_smiles'], meta['n_templates'], meta['rdkit_version'], meta['python_version'])]
+    for name, result in results['benchmarks'].items():
+        if 'seconds' not in result:
+            continue
+        rates = ', '.join('{:.1f} {}'.format(value, key.replace('_', ' ')) for (key, value)
+            in sorted(result.items()) if key.endswith('_per_second') and value is not None)
+        lines.append('{:<20s} {:>10.4f} s  ({})'.format(name, result['seconds'], rates))
+    if 'memory' in results['benchmarks']:
+        memory = results['benchmarks']['memory']
+        lines.append('{:<20s} {:>10.1f} MB peak traced, max RSS {} kB'.format('memory',
+            memory['peak_bytes'] / 1e6, memory['max_rss_kb']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark rdchiral on the bundled USPTO molecules')
+    parser.add_argument('--smiles', default=DEFAULT_SMILES_PATH, help='SMILES file, one per line')
+    parser.add_argument('--cases', default=DEFAULT_CASES_PATH, help='test cases JSON file')
+    parser.add_argument('--n-smiles', type=int, default=1000, help='number of molecules to use')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of each benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='skip the memory pass')
+    parser.add_argument('--memory-n-smiles', type=int, default=200,
+        help='number of molecules used for the memory pass')
+    parser.add_argument('-o', '--output', help='write JSON results to this file ("-" for stdout)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.smiles, args.cases, n_smiles=args.n_smiles, repeat=args.repeat,
+        memory=not args.no_memory, memory_n_smiles=args.memory_n_smiles)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_results(results))
+        if args.output:
+            with open(args.output, 'w') as fid:
+                json.dump(results, fid, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+from __future__ import print_function
+import argparse
+import gzip
+import json
+import math
+import sys
+from time import perf_counter
+
+import rdkit
+
+from rdchiral.initialization import rdchiralReaction, rdchiralReactants
+from rdchiral.main import rdchiralRun
+from rdchiral.stats import rdchiralStats, PHASES
+from rdchiral.benchmarks.benchmark import DEFAULT_SMILES_PATH, DEFAULT_CASES_PATH, \
+    load_smiles, load_cases
+
+'''
+This file contains a regression harness that checks correctness and speed together.
+
+`record` applies every template of the test cases to the first `n_smiles`
+molecules of the bundled USPTO set (plus the test case reactants) and saves
+
+    golden   the outcomes, atom-mapped outcomes and changed atoms of every
+             (template, molecule) pair with at least one outcome
+    timings  seconds spent in each phase of rdchiralRun (see `rdchiral.stats`),
+             in reactant/reaction initialization and in total, once per repetition
+
+`compare` repeats the same runs and reports
+
+    diffs        pairs whose outcomes changed (missing or new outcomes, or different
+                 atom mapping), which are stereochemistry changes in disguise more
+                 often than not
+    slowdowns    phases that got slower by at least `min_slowdown`, where a one-sided
+                 Mann-Whitney U test on the per-repetition timings is significant at
+                 level `alpha`
+
+Usage:
+
+    python -m rdchiral.benchmarks.regression record baseline.json.gz --n-smiles 2000 --repeat 5
+    python -m rdchiral.benchmarks.regression compare baseline.json.gz
+
+`compare` exits with status 1 if there are diffs or slowdowns. Baselines are
+only meaningful on the machine (and RDKit version) they were recorded on. With
+3 repetitions on each side the smallest possible p-value is 0.05, so use at
+least 5 (smallest p-value 0.004) with the default `alpha` of 0.01.
+'''
+
+TIMED = ('reactant_init', 'reaction_init', 'total') + PHASES
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+def _pair_key(i, j):
+    return '{}:{}'.format(i, j)
+
+def run_suite(smiles, smarts, repeat=5):
+    '''Apply every template to every molecule `repeat` times
+
+    Args:
+        smiles (list): Reactant SMILES strings
+        smarts (list): Reaction SMARTS strings
+        repeat (int): Number of repetitions
+
+    Returns:
+        (dict, dict): Golden outputs of the first repetition, keyed by
+            'template index:molecule index', and timing samples, keyed by phase
+    '''
+    golden = {}
+    timings = {name: [] for name in TIMED}
+    for k in range(repeat):
+        t0 = perf_counter()
+        reactants = [rdchiralReactants(smi) for smi in smiles]
+        t1 = perf_counter()
+        rxns = [rdchiralReaction(sma) for sma in smarts]
+        t2 = perf_counter()
+        stats = rdchiralStats()
+        for i, rxn in enumerate(rxns):
+            for j, r in enumerate(reactants):
+                outcomes = rdchiralRun(rxn, r, return_mapped=True, stats=stats)
+                if k == 0 and outcomes:
+                    outcomes, mapped_outcomes = outcomes
+                    golden[_pair_key(i, j)] = [sorted(outcomes), sorted(
+                        [smi, mapped, sorted(atoms_changed)]
+                        for (smi, (mapped, atoms_changed)) in mapped_outcomes.items())]
+        t3 = perf_counter()
+        timings['reactant_init'].append(t1 - t0)
+        timings['reaction_init'].append(t2 - t1)
+        timings['total'].append(t3 - t0)
+        for phase in PHASES:
+            timings[phase].append(stats.times.get(phase, 0.))
+    return golden, timings
+
+def record(path, smiles_path=DEFAULT_SMILES_PATH, cases_path=DEFAULT_CASES_PATH, n_smiles=2000,
+        repeat=5):
+    '''Record golden outputs and timing baselines
+
+    Args:
+        path (str): Output baseline file (gzipped if it ends with .gz)
+        smiles_path (str): SMILES file, one molecule per line
+        cases_path (str): Test cases JSON file
+        n_smiles (int): Number of molecules from `smiles_path` to use
+        repeat (int): Number of timed repetitions
+
+    Returns:
+        dict: The baseline that was written
+    '''
+    cases = load_cases(cases_path)
+    smiles = load_smiles(smiles_path, n_smiles) + [case['smiles'] for case in cases]
+    smarts = [case['smarts'] for case in cases]
+    golden, timings = run_suite(smiles, smarts, repeat)
+    baseline = {
+        'meta': {
+            'rdkit_version': rdkit.__version__,
+            'n_smiles': n_smiles,
+            'repeat': repeat,
+        },
+        'smiles': smiles,
+        'smarts': smarts,
+        'golden': golden,
+        'timings': timings,
+    }
+    with _open(path, 'w') as fid:
+        json.dump(baseline, fid)
+    return baseline
+
+def _exact_u_pvalue(u, n1, n2):
+    '''P(U >= u) under the null hypothesis, without ties'''
+    # counts[n][m][s]: number of arrangements of n x's and m y's with U = s,
+    # built with the recurrence c(n, m, s) = c(n - 1, m, s - m) + c(n, m - 1, s)
+    counts = [[None] * (n2 + 1) for _ in range(n1 + 1)]
+    for n in range(n1 + 1):
+        for m in range(n2 + 1):
+            if n == 0 or m == 0:
+                counts[n][m] = [1]
+                continue
+            size = n * m + 1
+            row = [0] * size
+            for (s, c) in enumerate(counts[n - 1][m]):
+                row[s + m] += c
+            for (s, c) in enumerate(counts[n][m - 1]):
+                row[s] += c
+            counts[n][m] = row
+    dist = counts[n1][n2]
+    return float(sum(dist[int(math.ceil(u)):])) / sum(dist)
+
+def mann_whitney_u(x, y):
+    '''One-sided Mann-Whitney U test of whether x tends to be larger than y
+
+    Uses the exact null distribution for small samples without ties and the
+    normal approximation (with tie and continuity correction) otherwise.
+
+    Args:
+        x (list): Samples, e.g., current timings
+        y (list): Samples, e.g., baseline timings
+
+    Returns:
+        (float, float): U statistic of x and the p-value
+    '''
+    n1, n2 = len(x), len(y)
+    if not n1 or not n2:
+        return 0., 1.
+    values = sorted([(v, 0) for v in x] + [(v, 1) for v in y])
+    ranks = [0.] * len(values)
+    tie_sum = 0.
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2. + 1.
+        t = j - i + 1
+        tie_sum += t ** 3 - t
+        i = j + 1
+    r1 = sum(rank for (rank, (_, group)) in zip(ranks, values) if group == 0)
+    u = r1 - n1 * (n1 + 1) / 2.
+    if not tie_sum and n1 * n2 <= 400:
+        return u, _exact_u_pvalue(u, n1, n2)
+    n = n1 + n2
+    variance = n1 * n2 / 12. * ((n + 1) - tie_sum / (n * (n - 1)))
+    if variance <= 0:
+        return u, 1.
+    z = (u - n1 * n2 / 2. - 0.5) / math.sqrt(variance)
+    return u, 0.5 * math.erfc(z / math.sqrt(2.))
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.
+
+def diff_golden(baseline, current, smiles, smarts):
+    '''Pairs whose outputs differ between two golden dicts
+
+    Returns:
+        list: One dict per differing pair, with keys 'smarts', 'smiles', 'missing'
+            and 'new' (outcomes only in the baseline or only in the current run)
+            and 'mapping_changed' (whether only the atom-mapped outputs differ)
+    '''
+    diffs = []
+    for key in sorted(set(baseline) | set(current), key=lambda key: tuple(map(int, key.split(':')))):
+        old = baseline.get(key, [[], []])
+        new = current.get(key, [[], []])
+        if old == new:
+            continue
+        i, j = map(int, key.split(':'))
+        diffs.append({
+            'smarts': smarts[i],
+            'smiles': smiles[j],
+            'missing': sorted(set(old[0]) - set(new[0])),
+            'new': sorted(set(new[0]) - set(old[0])),
+            'mapping_changed': old[0] == new[0],
+        })
+    return diffs
+
+def compare(path, repeat=None, alpha=0.01, min_slowdown=0.05):
+    '''Rerun a recorded baseline and compare outputs and timings
+
+    Args:
+        path (str): Baseline file written by `record`
+        repeat (int, optional): Number of timed repetitions, defaults to the baseline's
+        alpha (float): Significance level of the per-phase Mann-Whitney U test
+        min_slowdown (float): Smallest relative increase in median time that counts
+            as a slowdown, so that tiny but consistent differences are not reported
+
+    Returns:
+        dict: Report with keys 'meta', 'diffs', 'phases' (per-phase medians,
+            ratio, p-value and whether it is a slowdown) and 'slowdowns'
+    '''
+    with _open(path, 'r') as fid:
+        baseline = json.load(fid)
+    if repeat is None:
+        repeat = baseline['meta']['repeat']
+    smiles, smarts = baseline['smiles'], baseline['smarts']
+    golden, timings = run_suite(smiles, smarts, repeat)
+
+    phases = {}
+    for name in TIMED:
+        old, new = baseline['timings'].get(name), timings[name]
+        if not old or not any(old) and not any(new):
+            continue
+        old_median, new_median = _median(old), _median(new)
+        ratio = new_median / old_median if old_median > 0 else None
+        _, p = mann_whitney_u(new, old)
+        phases[name] = {
+            'baseline_median': old_median,
+            'median': new_median,
+            'ratio': ratio,
+            'p_value': p,
+            'slowdown': ratio is not None and p < alpha and ratio >= 1. + min_slowdown,
+        }
+
+    return {
+        'meta': {
+            'baseline_rdkit_version': baseline['meta']['rdkit_version'],
+            'rdkit_version': rdkit.__version__,
+            'n_smiles': len(smiles),
+            'n_templates': len(smarts),
+            'repeat': repeat,
+            'alpha': alpha,
+            'min_slowdown': min_slowdown,
+        },
+        'diffs': diff_golden(baseline['golden'], golden, smiles, smarts),
+        'phases': phases,
+        'slowdowns': sorted(name for (name, phase) in phases.items() if phase['slowdown']),
+    }
+
+def format_report(report, max_diffs=20):
+    '''Human-readable summary of a `compare` report'''
+    meta = report['meta']
+    lines = []
+    if meta['baseline_rdkit_version'] != meta['rdkit_version']:
+        lines.append('warning: baseline recorded with RDKit {}, running RDKit {}'.format(
+            meta['baseline_rdkit_version'], meta['rdkit_version']))
+    lines.append('{} of {} pairs changed'.format(len(report['diffs']),
+        meta['n_smiles'] * meta['n_templates']))
+    for diff in report['diffs'][:max_diffs]:
+        lines.append('  {} + {}'.format(diff['smarts'], diff['smiles']))
+        if diff['mapping_changed']:
+            lines.append('    atom mapping changed')
+        for smi in diff['missing']:
+            lines.append('    - {}'.format(smi))
+        for smi in diff['new']:
+            lines.append('    + {}'.format(smi))
+    if len(report['diffs']) > max_diffs:
+        lines.append('  ... {} more'.format(len(report['diffs']) - max_diffs))
+    lines.append('{:<20s} {:>10s} {:>10s} {:>7s} {:>8s}'.format('phase', 'baseline', 'current',
+        'ratio', 'p'))
+    for (name, phase) in report['phases'].items():
+        lines.append('{:<20s} {:>10.4f} {:>10.4f} {:>7s} {:>8.4f}{}'.format(name,
+            phase['baseline_median'], phase['median'],
+            '{:.3f}'.format(phase['ratio']) if phase['ratio'] is not None else '-',
+            phase['p_value'], '  SLOWER' if phase['slowdown'] else ''))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record or check rdchiral outputs and timings')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_record = subparsers.add_parser('record', help='record a new baseline')
+    parser_record.add_argument('baseline', help='baseline file (.json or .json.gz)')
+    parser_record.add_argument('--smiles', default=DEFAULT_SMILES_PATH, help='SMILES file, one per line')
+    parser_record.add_argument('--cases', default=DEFAULT_CASES_PATH, help='test cases JSON file')
+    parser_record.add_argument('--n-smiles', type=int, default=2000, help='number of molecules to use')
+    parser_record.add_argument('--repeat', type=int, default=5, help='timed repetitions')
+    parser_compare = subparsers.add_parser('compare', help='compare against a baseline')
+    parser_compare.add_argument('baseline', help='baseline file written by record')
+    parser_compare.add_argument('--repeat', type=int, help='timed repetitions (default: as recorded)')
+    parser_compare.add_argument('--alpha', type=float, default=0.01, help='significance level')
+    parser_compare.add_argument('--min-slowdown', type=float, default=0.05,
+        help='smallest relative slowdown to report')
+    parser_compare.add_argument('-o', '--output', help='also write the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        baseline = record(args.baseline, args.smiles, args.cases, n_smiles=args.n_smiles,
+            repeat=args.repeat)
+        print('Recorded {} pairs with outcomes, total {:.2f} s per repetition'.format(
+            len(baseline['golden']), _median(baseline['timings']['total'])))
+        return 0
+    elif args.command == 'compare':
+        report = compare(args.baseline, repeat=args.repeat, alpha=args.alpha,
+            min_slowdown=args.min_slowdown)
+        print(format_report(report))
+        if args.output:
+            with open(args.output, 'w') as fid:
+                json.dump(report, fid, indent=2)
+        return 1 if report['diffs'] or report['slowdowns'] else 0
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
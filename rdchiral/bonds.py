@@ -1,7 +1,8 @@
 import rdkit.Chem as Chem
 import rdkit.Chem.AllChem as AllChem
 from rdkit.Chem.rdchem import ChiralType, BondType, BondDir, BondStereo
-from rdchiral.utils import vprint, PLEVEL
+from rdchiral import utils
+from rdchiral.utils import vprint
 
 BondDirOpposite = {AllChem.BondDir.ENDUPRIGHT: AllChem.BondDir.ENDDOWNRIGHT,
                    AllChem.BondDir.ENDDOWNRIGHT: AllChem.BondDir.ENDUPRIGHT,
@@ -76,10 +77,11 @@ def enumerate_possible_cistrans_defs(template_r, labeling_func=lambda a: a.GetAt
         (dict, set): Returns required_bond_defs and required_bond_defs_coreatoms
     '''
 
+    tracer = utils.TRACER
     required_bond_defs = {}
     required_bond_defs_coreatoms = set()
 
-    if PLEVEL >= 10: print('Looking at initializing template frag')
+    if tracer is not None: tracer(10, 'template_bonds_start')
     for b in template_r.GetBonds():
         if b.GetBondType() != BondType.DOUBLE:
             continue
@@ -95,10 +97,8 @@ def enumerate_possible_cistrans_defs(template_r, labeling_func=lambda a: a.GetAt
         ba_label = labeling_func(ba)
         bb_label = labeling_func(bb)
             
-        if PLEVEL >= 10: print('Found a double bond with potential cis/trans (based on degree)')
-        if PLEVEL >= 10: print('{} {} {}'.format(ba_label,
-                               b.GetSmarts(),
-                               bb_label))
+        if tracer is not None: tracer(10, 'template_double_bond', begin=ba_label,
+            bond=b.GetSmarts(), end=bb_label)
 
         # Save core atoms so we know that cis/trans was POSSIBLE to specify
         required_bond_defs_coreatoms.add((ba_label, bb_label))
@@ -136,11 +136,8 @@ def enumerate_possible_cistrans_defs(template_r, labeling_func=lambda a: a.GetAt
                     break
                 front_spec = bab.GetBondDir()
                 break
-        if front_spec is None:
-            if PLEVEL >= 10: print('Chirality not specified at front end of the bond!')
-        else:
-            if PLEVEL >= 10: print('Front specification: {}'.format(front_spec))
-            
+        if tracer is not None: tracer(10, 'template_bond_front_spec', spec=front_spec)
+        if front_spec is not None:
             for bbb in bb.GetBonds():
                 if bbb.GetBondDir() != BondDir.NONE:
                     # For the "back" specification, the double-bonded atom *should* be the BeginAtom
@@ -158,10 +155,7 @@ def enumerate_possible_cistrans_defs(template_r, labeling_func=lambda a: a.GetAt
                         break
                     back_spec = bbb.GetBondDir()
                     break
-        if back_spec is None:
-            if PLEVEL >= 10: print('Chirality not specified at back end of the bond!')
-        else:
-            if PLEVEL >= 10: print('Back specification: {}'.format(back_spec))
+        if tracer is not None: tracer(10, 'template_bond_back_spec', spec=back_spec)
 
         # Is this an overall unspecified bond? Put it in the dictionary anyway, 
         # so there is something to match
@@ -180,11 +174,11 @@ def enumerate_possible_cistrans_defs(template_r, labeling_func=lambda a: a.GetAt
             continue
         
         if front_spec == back_spec:
-            if PLEVEL >= 10: print('-> locally TRANS')
             b.SetProp('localChirality', 'trans')
         else:
-            if PLEVEL >= 10: print('--> locally CIS')
             b.SetProp('localChirality', 'cis')
+        if tracer is not None: tracer(10, 'template_bond_local_chirality',
+            begin=ba_label, end=bb_label, chirality=b.GetProp('localChirality'))
 
         possible_defs = {}
         for start_atom in ba_neighbor_labels:
@@ -217,10 +211,41 @@ def enumerate_possible_cistrans_defs(template_r, labeling_func=lambda a: a.GetAt
         # Save to the definition of this bond (in either direction)
         required_bond_defs.update(possible_defs)
         
-    if PLEVEL >= 10: print('All bond specs for this template:' )
-    if PLEVEL >= 10: print(str([(k, v) for (k, v) in required_bond_defs.items()]))
+    if tracer is not None: tracer(10, 'template_bond_defs', defs=required_bond_defs)
     return required_bond_defs, required_bond_defs_coreatoms
 
+def check_template_bond_dirs(atoms_rt_old, atoms_across_double_bonds, required_rt_bond_defs):
+    '''Check that double bond stereo in a molecule is consistent with the template
+
+    Iterates through the molecule's double bonds where chirality is specified
+    (or not). When all atoms defining a bond were matched to the reactant
+    template, the bond directions must match one of the template's enumerated
+    definitions (/=/ also matches \\=\\ since they are both trans).
+
+    Args:
+        atoms_rt_old (dict): Molecule map number -> template map number of matched atoms
+        atoms_across_double_bonds (list): from `get_atoms_across_double_bonds` on the molecule
+        required_rt_bond_defs (dict): from `enumerate_possible_cistrans_defs` on the template
+
+    Returns:
+        bool: Whether all matched double bonds are consistent
+    '''
+    for atoms, dirs, is_implicit in atoms_across_double_bonds:
+        if all(i in atoms_rt_old for i in atoms):
+            # Convert to original template's atom map numbers
+            matched_atom_map_nums = tuple(atoms_rt_old[i] for i in atoms)
+
+            if matched_atom_map_nums not in required_rt_bond_defs:
+                continue # this can happen in ring openings, for example
+            dirs_template = required_rt_bond_defs[matched_atom_map_nums]
+            if dirs != dirs_template and \
+                    (BondDirOpposite[dirs[0]], BondDirOpposite[dirs[1]]) != dirs_template and \
+                    not (dirs_template == (BondDir.NONE, BondDir.NONE) and is_implicit):
+                if utils.TRACER is not None: utils.TRACER(5, 'bond_stereo_mismatch',
+                    mapnums=matched_atom_map_nums, dirs=dirs, dirs_template=dirs_template)
+                return False
+    return True
+
 def get_atoms_across_double_bonds(mol, labeling_func=lambda a: a.GetAtomMapNum()):
     '''This function takes a molecule and returns a list of cis/trans specifications
     according to the following:
@@ -252,6 +277,7 @@ def get_atoms_across_double_bonds(mol, labeling_func=lambda a: a.GetAtomMapNum()
     Returns:
         list: atoms_across_double_bonds
     '''
+    tracer = utils.TRACER
     atoms_across_double_bonds = []
     atomrings = None
 
@@ -270,10 +296,8 @@ def get_atoms_across_double_bonds(mol, labeling_func=lambda a: a.GetAtomMapNum()
         ba_label = labeling_func(ba)
         bb_label = labeling_func(bb)
             
-        if PLEVEL >= 5: print('Found a double bond with potential cis/trans (based on degree)')
-        if PLEVEL >= 5: print('{} {} {}'.format(ba_label,
-                               b.GetSmarts(),
-                               bb_label))
+        if tracer is not None: tracer(5, 'double_bond', begin=ba_label,
+            bond=b.GetSmarts(), end=bb_label)
         
         # Try to specify front and back direction separately
         front_mapnums = None 
@@ -311,11 +335,11 @@ def get_atoms_across_double_bonds(mol, labeling_func=lambda a: a.GetAtomMapNum()
                         if (bab.GetOtherAtomIdx(ba.GetIdx()) in atomring) != \
                                 (bbb.GetOtherAtomIdx(bb.GetIdx()) in atomring):
                             # one of these atoms are in the ring, one is outside -> trans
-                            if PLEVEL >= 10: print('Implicit trans found')
+                            if tracer is not None: tracer(10, 'implicit_ring_stereo', stereo='trans')
                             front_dir = BondDir.ENDUPRIGHT
                             back_dir = BondDir.ENDUPRIGHT
                         else:
-                            if PLEVEL >= 10: print('Implicit cis found')
+                            if tracer is not None: tracer(10, 'implicit_ring_stereo', stereo='cis')
                             front_dir = BondDir.ENDUPRIGHT 
                             back_dir = BondDir.ENDDOWNRIGHT
                         is_implicit = True 
@@ -362,6 +386,7 @@ def restore_bond_stereo_to_sp2_atom(a, bond_dirs_by_mapnum):
         bool: Returns Trueif a bond direction was copied
     '''
 
+    tracer = utils.TRACER
     for bond_to_spec in a.GetBonds():
         if (bond_to_spec.GetOtherAtom(a).GetAtomMapNum(), a.GetAtomMapNum()) in bond_dirs_by_mapnum:
             bond_to_spec.SetBondDir(
@@ -370,14 +395,13 @@ def restore_bond_stereo_to_sp2_atom(a, bond_dirs_by_mapnum):
                      bond_to_spec.GetEndAtom().GetAtomMapNum())
                 ]
             )
-            if PLEVEL >= 2: print('Tried to copy bond direction b/w {} and {}'.format(
-                bond_to_spec.GetBeginAtom().GetAtomMapNum(),
-                bond_to_spec.GetEndAtom().GetAtomMapNum()
-            ))
+            if tracer is not None: tracer(2, 'bond_dir_copied',
+                begin=bond_to_spec.GetBeginAtom().GetAtomMapNum(),
+                end=bond_to_spec.GetEndAtom().GetAtomMapNum())
             return True
     
     # Weird case, like C=C/O >> C=C/Br
-    if PLEVEL >= 2: print('Bond stereo could not be restored to sp2 atom, missing the branch that was used to define before...')
+    if tracer is not None: tracer(2, 'bond_dir_branch_missing', mapnum=a.GetAtomMapNum())
     
     if a.GetDegree() == 2:
         # Either the branch used to define was replaced with H (deg 3 -> deg 2)
@@ -387,11 +411,11 @@ def restore_bond_stereo_to_sp2_atom(a, bond_dirs_by_mapnum):
                 continue
             if not bond_to_spec.GetOtherAtom(a).HasProp('old_mapno'): 
                 # new atom, deg2->deg2, assume direction preserved
-                if PLEVEL >= 5: print('Only single-bond attachment to atom {} is new, try to reproduce chirality'.format(a.GetAtomMapNum()))
+                if tracer is not None: tracer(5, 'bond_dir_single_attachment', mapnum=a.GetAtomMapNum(), new=True)
                 needs_inversion = False 
             else:
                 # old atom, just was not used in chirality definition - set opposite
-                if PLEVEL >= 5: print('Only single-bond attachment to atom {} is old, try to reproduce chirality'.format(a.GetAtomMapNum()))
+                if tracer is not None: tracer(5, 'bond_dir_single_attachment', mapnum=a.GetAtomMapNum(), new=False)
                 needs_inversion = True
 
             for (i, j), bond_dir in bond_dirs_by_mapnum.items():
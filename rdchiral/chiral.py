@@ -1,7 +1,8 @@
 from __future__ import print_function
 from rdkit.Chem.rdchem import ChiralType, BondType, BondDir
 
-from rdchiral.utils import vprint, parity4, PLEVEL
+from rdchiral import utils
+from rdchiral.utils import vprint, parity4
 
 def template_atom_could_have_been_tetra(a, strip_if_spec=False, cache=True):
     '''Could this atom have been a tetrahedral center?
@@ -32,6 +33,128 @@ def template_atom_could_have_been_tetra(a, strip_if_spec=False, cache=True):
 
 
 
+def template_chirality_by_mapnum(template):
+    '''Tabulate what `atom_chirality_matches` needs to know about template atoms
+
+    Args:
+        template (rdkit.Chem.rdchem.Mol): Template fragment, with map numbers on all
+            atoms and tetra_possible assigned (see `template_atom_could_have_been_tetra`)
+
+    Returns:
+        dict: Mapping from atom map number to (ChiralType, could have been tetra,
+            tuple of neighbor atom map numbers)
+    '''
+    return {a.GetAtomMapNum(): (a.GetChiralTag(), template_atom_could_have_been_tetra(a),
+        tuple(n.GetAtomMapNum() for n in a.GetNeighbors())) for a in template.GetAtoms()
+        if a.GetAtomMapNum()}
+
+def molecule_chirality_by_mapnum(mol):
+    '''Tabulate what `atom_chirality_matches` needs to know about molecule atoms
+
+    Atoms that are neither tetrahedral centers nor possible stereocenters are left
+    out, since they match any template atom.
+
+    Args:
+        mol (rdkit.Chem.rdchem.Mol): Molecule with map numbers on all atoms
+
+    Returns:
+        dict: Mapping from atom map number to (ChiralType, chirality possible,
+            tuple of neighbor atom map numbers)
+    '''
+    chirality_by_mapnum = {}
+    for a in mol.GetAtoms():
+        possible = a.HasProp('_ChiralityPossible')
+        if a.GetChiralTag() != ChiralType.CHI_UNSPECIFIED or possible:
+            chirality_by_mapnum[a.GetAtomMapNum()] = (a.GetChiralTag(), possible,
+                tuple(n.GetAtomMapNum() for n in a.GetNeighbors()))
+    return chirality_by_mapnum
+
+def check_template_chirality(atoms_rt_old, rt_chirality_by_mapnum, r_chirality_by_mapnum):
+    '''Check that all matched atoms agree in chirality with the reactant template
+
+    This is the same check as calling `atom_chirality_matches` on every matched
+    pair of template/molecule atoms (after renumbering the template to molecule
+    map numbers), but works on pre-tabulated values only. All matched atoms must
+    either match (+1) or all be inverted (-1), ignoring ambiguous ones (2).
+
+    Args:
+        atoms_rt_old (dict): Molecule map number -> template map number of matched atoms
+        rt_chirality_by_mapnum (dict): from `template_chirality_by_mapnum`
+        r_chirality_by_mapnum (dict): from `molecule_chirality_by_mapnum`
+
+    Returns:
+        str: None if the match is consistent, otherwise the reason to reject it,
+            'chirality_violated' or 'partial_inversion'
+    '''
+    tmp_to_mol = {}
+    for (i, old) in atoms_rt_old.items():
+        tmp_to_mol[old] = i
+
+    prev = None
+    for (i, old) in atoms_rt_old.items():
+        a_mol = r_chirality_by_mapnum.get(i)
+        if a_mol is None:
+            continue # achiral and can't be chiral -> ambiguous
+        tmp_tag, tmp_tetra_possible, tmp_neighbors = rt_chirality_by_mapnum[old]
+        mol_tag, mol_possible, mol_neighbors = a_mol
+        match = tabulated_chirality_matches(tmp_tag, tmp_tetra_possible,
+            [tmp_to_mol.get(j, j) for j in tmp_neighbors], mol_tag, mol_possible, mol_neighbors)
+        if match == 0:
+            return 'chirality_violated'
+        elif match == 2: # ambiguous case
+            continue
+        elif prev is None:
+            prev = match
+        elif match != prev:
+            return 'partial_inversion'
+    return None
+
+def tabulated_chirality_matches(tmp_tag, tmp_tetra_possible, mapnums_tmp, mol_tag, mol_possible, mapnums_mol):
+    '''Same as `atom_chirality_matches`, from tabulated atom information
+
+    Args:
+        tmp_tag (ChiralType): Chiral tag of the template atom
+        tmp_tetra_possible (bool): Whether the template atom could have been tetrahedral
+        mapnums_tmp (list): Current map numbers of the template atom's neighbors
+        mol_tag (ChiralType): Chiral tag of the molecule atom
+        mol_possible (bool): Whether the molecule atom has _ChiralityPossible
+        mapnums_mol (tuple): Map numbers of the molecule atom's neighbors
+
+    Returns:
+        int: Integer value of match result, see `atom_chirality_matches`
+    '''
+    if mol_tag == ChiralType.CHI_UNSPECIFIED:
+        if tmp_tag == ChiralType.CHI_UNSPECIFIED:
+            return 2 # achiral template, achiral molecule -> match
+        if not mol_possible:
+            return 2
+        return 0
+    if tmp_tag == ChiralType.CHI_UNSPECIFIED:
+        if tmp_tetra_possible:
+            return 0
+        return 2
+
+    # When there are fewer than 3 heavy neighbors, chirality is ambiguous...
+    if len(mapnums_tmp) < 3 or len(mapnums_mol) < 3:
+        return 2
+
+    # Degree of 3 -> remaining atom is a hydrogen, add to list
+    mapnums_mol = list(mapnums_mol)
+    if len(mapnums_tmp) < 4:
+        mapnums_tmp.append(-1) # H
+    if len(mapnums_mol) < 4:
+        mapnums_mol.append(-1) # H
+
+    only_in_src = [i for i in mapnums_tmp if i not in mapnums_mol][::-1] # reverse for popping
+    only_in_mol = [i for i in mapnums_mol if i not in mapnums_tmp]
+    if len(only_in_src) <= 1 and len(only_in_mol) <= 1:
+        tmp_parity = parity4(mapnums_tmp)
+        mol_parity = parity4([i if i in mapnums_tmp else only_in_src.pop() for i in mapnums_mol])
+        parity_matches = tmp_parity == mol_parity
+        tag_matches = tmp_tag == mol_tag
+        return 1 if parity_matches == tag_matches else -1
+    return 2 # ambiguous case, just return for now
+
 def copy_chirality(a_src, a_new):
     '''Copy chirality from a_src to a_new
 
@@ -50,12 +173,13 @@ def copy_chirality(a_src, a_new):
             any(b.GetBondType() != BondType.SINGLE for b in a_new.GetBonds()):
         return
 
-    if PLEVEL >= 3: print('For mapnum {}, copying src {} chirality tag to new'.format(
-        a_src.GetAtomMapNum(), a_src.GetChiralTag()))
+    tracer = utils.TRACER
+    if tracer is not None: tracer(3, 'chirality_copied', mapnum=a_src.GetAtomMapNum(),
+        tag=a_src.GetChiralTag())
     a_new.SetChiralTag(a_src.GetChiralTag())
     
     if atom_chirality_matches(a_src, a_new) == -1:
-        if PLEVEL >= 3: print('For mapnum {}, inverting chirality'.format(a_new.GetAtomMapNum()))
+        if tracer is not None: tracer(3, 'chirality_inverted', mapnum=a_new.GetAtomMapNum())
         a_new.InvertChirality()
 
 def atom_chirality_matches(a_tmp, a_mol):
@@ -75,71 +199,14 @@ def atom_chirality_matches(a_tmp, a_mol):
             0 if an explicit NOT match
             2 if ambiguous or achiral-achiral
     '''
-    if a_mol.GetChiralTag() == ChiralType.CHI_UNSPECIFIED:
-        if a_tmp.GetChiralTag() == ChiralType.CHI_UNSPECIFIED:
-            if PLEVEL >= 3: print('atom {} is achiral & achiral -> match'.format(a_mol.GetAtomMapNum()))
-            return 2 # achiral template, achiral molecule -> match
-        # What if the template was chiral, but the reactant isn't just due to symmetry?
-        if not a_mol.HasProp('_ChiralityPossible'):
-            # It's okay to make a match, as long as the product is achiral (even
-            # though the product template will try to impose chirality)
-            if PLEVEL >= 3: print('atom {} is specified in template, but cant possibly be chiral in mol'.format(a_mol.GetAtomMapNum()))
-            return 2
-
-        # Discussion: figure out if we want this behavior - should a chiral template
-        # be applied to an achiral molecule? For the retro case, if we have
-        # a retro reaction that requires a specific stereochem, return False;
-        # however, there will be many cases where the reaction would probably work
-        if PLEVEL >= 3: print('atom {} is achiral in mol, but specified in template'.format(a_mol.GetAtomMapNum()))
-        return 0
-    if a_tmp.GetChiralTag() == ChiralType.CHI_UNSPECIFIED:
-        if PLEVEL >= 3: print('Reactant {} atom chiral, rtemplate achiral...'.format(a_tmp.GetAtomMapNum()))
-        if template_atom_could_have_been_tetra(a_tmp):
-            if PLEVEL >= 3: print('...and that atom could have had its chirality specified! no_match')
-            return 0
-        if PLEVEL >= 3: print('...but the rtemplate atom could not have had chirality specified, match anyway')
-        return 2
-
-    mapnums_tmp = [a.GetAtomMapNum() for a in a_tmp.GetNeighbors()]    
-    mapnums_mol = [a.GetAtomMapNum() for a in a_mol.GetNeighbors()]
-
-    # When there are fewer than 3 heavy neighbors, chirality is ambiguous...
-    if len(mapnums_tmp) < 3 or len(mapnums_mol) < 3:
-        return 2
-
-    # Degree of 3 -> remaining atom is a hydrogen, add to list
-    if len(mapnums_tmp) < 4:
-        mapnums_tmp.append(-1) # H
-    if len(mapnums_mol) < 4:
-        mapnums_mol.append(-1) # H
-
-    try:
-        if PLEVEL >= 10: print(str(mapnums_tmp))
-        if PLEVEL >= 10: print(str(mapnums_mol))
-        if PLEVEL >= 10: print(str(a_tmp.GetChiralTag()))
-        if PLEVEL >= 10: print(str(a_mol.GetChiralTag()))
-        only_in_src = [i for i in mapnums_tmp if i not in mapnums_mol][::-1] # reverse for popping
-        only_in_mol = [i for i in mapnums_mol if i not in mapnums_tmp]
-        if len(only_in_src) <= 1 and len(only_in_mol) <= 1:
-            tmp_parity = parity4(mapnums_tmp)
-            mol_parity = parity4([i if i in mapnums_tmp else only_in_src.pop() for i in mapnums_mol])
-            if PLEVEL >= 10: print(str(tmp_parity))
-            if PLEVEL >= 10: print(str(mol_parity))
-            parity_matches = tmp_parity == mol_parity
-            tag_matches = a_tmp.GetChiralTag() == a_mol.GetChiralTag()
-            chirality_matches = parity_matches == tag_matches
-            if PLEVEL >= 2: print('mapnum {} chiral match? {}'.format(a_tmp.GetAtomMapNum(), chirality_matches))
-            return 1 if chirality_matches else -1
-        else:
-            if PLEVEL >= 2: print('mapnum {} chiral match? Based on mapnum lists, ambiguous -> True'.format(a_tmp.GetAtomMapNum()))
-            return 2 # ambiguous case, just return for now
-
-    except IndexError as e:
-        print(a_tmp.GetPropsAsDict())
-        print(a_mol.GetPropsAsDict())
-        print(a_tmp.GetChiralTag())
-        print(a_mol.GetChiralTag())
-        print(str(e))
-        print(str(mapnums_tmp))
-        print(str(mapnums_mol))
-        raise KeyError('Pop from empty set - this should not happen!')
\ No newline at end of file
+    tmp_tag = a_tmp.GetChiralTag()
+    mol_tag = a_mol.GetChiralTag()
+    # only looked up when it decides the result
+    tmp_tetra_possible = tmp_tag == ChiralType.CHI_UNSPECIFIED and \
+        mol_tag != ChiralType.CHI_UNSPECIFIED and template_atom_could_have_been_tetra(a_tmp)
+    result = tabulated_chirality_matches(tmp_tag, tmp_tetra_possible,
+        [a.GetAtomMapNum() for a in a_tmp.GetNeighbors()], mol_tag,
+        a_mol.HasProp('_ChiralityPossible'), [a.GetAtomMapNum() for a in a_mol.GetNeighbors()])
+    if utils.TRACER is not None: utils.TRACER(3, 'atom_chirality_match', mapnum=a_tmp.GetAtomMapNum(),
+        result=result)
+    return result
@@ -3,7 +3,8 @@ import rdkit.Chem as Chem
 import re
 from itertools import chain
 
-from rdchiral.utils import vprint, PLEVEL
+from rdchiral import utils
+from rdchiral.utils import vprint
 
 
 def canonicalize_outcome_smiles(smiles, ensure=True):
@@ -24,14 +25,65 @@ def canonicalize_outcome_smiles(smiles, ensure=True):
     if ensure: 
         outcome = Chem.MolFromSmiles(smiles)
         if outcome is None:
-            if PLEVEL >= 1: print('~~ could not parse self?')
-            if PLEVEL >= 1: print('Attempted SMILES: {}', smiles)
+            if utils.TRACER is not None: utils.TRACER(1, 'canonicalization_failed', smiles=smiles)
             return None
 
         smiles = Chem.MolToSmiles(outcome, True)
 
     return  '.'.join(sorted(smiles.split('.')))
 
+class rdchiralOutcome(object):
+    '''Handle to one outcome of `rdchiralRun(..., return_outcomes=True)`
+
+    SMILES strings are only generated when they are first requested, so callers
+    that work on the outcome molecules directly (e.g., to fingerprint them) do
+    not pay for serializing and canonicalizing every outcome.
+
+    Attributes:
+        mol (rdkit.Chem.rdchem.Mol): Sanitized outcome molecule(s), with
+            stereochemistry corrected by rdchiral
+        atoms_changed (tuple): Atom map numbers of reactant atoms that changed
+
+    Args:
+        mol (rdkit.Chem.rdchem.Mol): Outcome molecule(s)
+        atoms_changed (tuple): Atom map numbers of reactant atoms that changed
+        mapnums (list, optional): Atom map numbers of `mol` if they have been
+            removed from it, used to generate the mapped SMILES
+        mapped_smiles (str, optional): Atom-mapped SMILES, if already known
+    '''
+    def __init__(self, mol, atoms_changed, mapnums=None, mapped_smiles=None):
+        self.mol = mol
+        self.atoms_changed = atoms_changed
+        self._mapnums = mapnums
+        self._smiles = None
+        self._smiles_done = False
+        self._mapped_smiles = mapped_smiles
+
+    @property
+    def smiles(self):
+        '''str: Canonical SMILES, as returned by `rdchiralRun`, or None if RDKit
+        could not parse its own SMILES for this outcome'''
+        if not self._smiles_done:
+            self._smiles = canonicalize_outcome_smiles(Chem.MolToSmiles(self.mol, True))
+            self._smiles_done = True
+        return self._smiles
+
+    @property
+    def mapped_smiles(self):
+        '''str: Atom-mapped SMILES of the outcome'''
+        if self._mapped_smiles is None:
+            if self._mapnums is None:
+                self._mapped_smiles = Chem.MolToSmiles(self.mol, True)
+            else:
+                mol = Chem.Mol(self.mol)
+                for (a, mapnum) in zip(mol.GetAtoms(), self._mapnums):
+                    a.SetAtomMapNum(mapnum)
+                self._mapped_smiles = Chem.MolToSmiles(mol, True)
+        return self._mapped_smiles
+
+    def __repr__(self):
+        return 'rdchiralOutcome({})'.format(self.smiles)
+
 def combine_enantiomers_into_racemic(final_outcomes):
     '''
     If two products are identical except for an inverted CW/CCW or an
@@ -0,0 +1,316 @@
+from __future__ import print_function
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import deque
+
+from rdkit import Chem
+
+from rdchiral import template_extractor
+
+'''
+This file contains a streaming template extraction pipeline for large reaction
+datasets (e.g., the 1976-2016 USPTO grants), around
+`template_extractor.extract_from_reaction`.
+
+Reactions are read lazily from
+
+    .rsmi      tab-separated USPTO file with a ReactionSmiles column (and PatentNumber)
+    .jsonl     one JSON reaction per line, with 'reactants' and 'products' (and
+               optionally 'spectators' and '_id') or a 'reaction_smiles' string
+    .json      a JSON array of the same reactions (loaded at once, not streamed)
+
+optionally gzipped (.rsmi.gz, .jsonl.gz). The `_id` of a reaction is its row
+number in the input unless the input provides one.
+
+Reactions are sent to worker processes in chunks, with a bounded number of
+chunks in flight, and results are written in input order as JSON lines: one
+template record per parsable reaction (just {'reaction_id': ...} if no
+template could be extracted), and optionally the cleaned reactions. Output
+files ending in .gz are written as one gzip member per chunk.
+
+After every chunk, a checkpoint file records how many input rows are done and
+how long the output files were. When a run is restarted, anything written
+after the last checkpoint is truncated away and reading resumes with the next
+row, so a crash loses at most the chunks that were in flight.
+'''
+
+def _open_text(path, mode='r'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+def _split_reaction_smiles(reaction_smiles):
+    '''Split 'reactants>spectators>products', dropping CXSMILES extensions'''
+    reaction_smiles = reaction_smiles.split(' ')[0]
+    reactants, spectators, products = reaction_smiles.split('>')
+    return reaction_smiles, reactants, spectators, products
+
+def read_rsmi(path):
+    '''Read reactions from a (gzipped) tab-separated USPTO .rsmi file
+
+    Args:
+        path (str): Input file, with a header line naming the ReactionSmiles column
+
+    Yields:
+        dict: reaction with keys '_id', 'reactants', 'spectators', 'products',
+            'source' and 'source_id' (a hash of the reaction SMILES and patent number)
+    '''
+    with _open_text(path) as fid:
+        header = fid.readline().rstrip('\r\n').split('\t')
+        smiles_col = header.index('ReactionSmiles')
+        patent_col = header.index('PatentNumber') if 'PatentNumber' in header else None
+        for i, line in enumerate(fid):
+            fields = line.rstrip('\r\n').split('\t')
+            try:
+                reaction_smiles, reactants, spectators, products = _split_reaction_smiles(fields[smiles_col])
+            except (IndexError, ValueError):
+                reaction_smiles, reactants, spectators, products = '', '', '', ''
+            patent = fields[patent_col] if patent_col is not None and patent_col < len(fields) else ''
+            yield {
+                '_id': i,
+                'reactants': reactants,
+                'spectators': spectators,
+                'products': products,
+                'source': 'uspto',
+                'source_id': hashlib.sha256((reaction_smiles + patent).encode('utf-8')).hexdigest(),
+            }
+
+def _prepare_reaction(reaction, i):
+    if 'reactants' not in reaction and 'reaction_smiles' in reaction:
+        _, reaction['reactants'], reaction['spectators'], reaction['products'] = \
+            _split_reaction_smiles(reaction['reaction_smiles'])
+    reaction.setdefault('_id', i)
+    return reaction
+
+def read_jsonl(path):
+    '''Read reactions from a (gzipped) JSON lines file
+
+    Args:
+        path (str): Input file, one JSON object per line
+
+    Yields:
+        dict: reaction with at least '_id', 'reactants' and 'products'
+    '''
+    with _open_text(path) as fid:
+        for i, line in enumerate(fid):
+            line = line.strip()
+            if not line:
+                continue
+            yield _prepare_reaction(json.loads(line), i)
+
+def read_json(path):
+    '''Read reactions from a (gzipped) JSON file holding an array of reactions
+
+    Note: the whole array is loaded into memory, convert large files to JSON
+    lines to stream them.
+
+    Args:
+        path (str): Input file, a JSON array of objects as for `read_jsonl`
+
+    Yields:
+        dict: reaction with at least '_id', 'reactants' and 'products'
+    '''
+    with _open_text(path) as fid:
+        reactions = json.load(fid)
+    if not isinstance(reactions, list):
+        raise ValueError('Expected a JSON array of reactions in {}'.format(path))
+    for i, reaction in enumerate(reactions):
+        yield _prepare_reaction(reaction, i)
+
+def read_reactions(path):
+    '''Read reactions lazily, choosing the reader from the file extension
+
+    Args:
+        path (str): .rsmi, .jsonl or .json file, optionally with a .gz suffix
+
+    Returns:
+        generator: reaction dicts, see `read_rsmi`, `read_jsonl` and `read_json`
+    '''
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.rsmi'):
+        return read_rsmi(path)
+    if name.endswith('.jsonl'):
+        return read_jsonl(path)
+    if name.endswith('.json'):
+        return read_json(path)
+    raise ValueError('Unknown reaction file type: {}'.format(path))
+
+def can_parse(reaction):
+    '''Whether RDKit can parse the reactants and products of a reaction'''
+    return bool(reaction.get('reactants') and reaction.get('products')) and \
+        Chem.MolFromSmiles(reaction['reactants']) is not None and \
+        Chem.MolFromSmiles(reaction['products']) is not None
+
+def extract(reaction):
+    '''Extract the template of one reaction, never raising for bad reactions
+
+    Returns:
+        dict: Template from `extract_from_reaction`, or {'reaction_id': ...} if
+            no template could be extracted
+    '''
+    try:
+        template = template_extractor.extract_from_reaction(reaction)
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        print(e)
+        template = None
+    if template is None:
+        template = {'reaction_id': reaction['_id']}
+    return template
+
+def extract_chunk(reactions):
+    '''Worker task: check and extract a chunk of reactions
+
+    Args:
+        reactions (list): reaction dicts
+
+    Returns:
+        list: (reaction, template) for each parsable reaction
+    '''
+    return [(reaction, extract(reaction)) for reaction in reactions if can_parse(reaction)]
+
+def _chunks(iterable, chunksize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class _ChunkWriter(object):
+    '''Appends JSON lines to a file, one gzip member per chunk for .gz files'''
+    def __init__(self, path, size):
+        self.path = path
+        self.compress = path.endswith('.gz')
+        if size and (not os.path.exists(path) or os.path.getsize(path) < size):
+            raise ValueError('Cannot resume, {} is missing or shorter than at the last '
+                'checkpoint (restart to start over)'.format(path))
+        with open(path, 'ab') as fid:
+            fid.truncate(size)
+        self.fid = open(path, 'ab')
+
+    def write(self, records):
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        if self.compress:
+            data = gzip.compress(data)
+        self.fid.write(data)
+
+    def flush(self):
+        '''Flush to disk and return the file size'''
+        self.fid.flush()
+        os.fsync(self.fid.fileno())
+        return self.fid.tell()
+
+    def close(self):
+        self.fid.close()
+
+def _read_checkpoint(checkpoint_path, input_path):
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as fid:
+        checkpoint = json.load(fid)
+    if checkpoint['input'] != os.path.abspath(input_path):
+        raise ValueError('Checkpoint {} belongs to a different input ({})'.format(
+            checkpoint_path, checkpoint['input']))
+    return checkpoint
+
+def _write_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as fid:
+        json.dump(checkpoint, fid)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+def extract_templates(input_path, templates_path, reactions_path=None, checkpoint_path=None,
+        processes=None, chunksize=1000, max_pending=None, resume=True):
+    '''Extract templates from a reaction file, streaming and resumable
+
+    Args:
+        input_path (str): Reaction file, see `read_reactions`
+        templates_path (str): Output JSON lines file of template records
+        reactions_path (str, optional): Output JSON lines file of the parsable reactions
+        checkpoint_path (str, optional): Checkpoint file, defaults to
+            `templates_path` + '.checkpoint'
+        processes (int, optional): Number of worker processes, defaults to the number
+            of CPUs. With 1, everything runs in this process
+        chunksize (int): Number of reactions per chunk (and per checkpoint)
+        max_pending (int, optional): Maximum number of chunks in flight, defaults to
+            twice the number of processes. This bounds memory use
+        resume (bool): Whether to continue from an existing checkpoint, otherwise
+            start over and overwrite the outputs
+
+    Returns:
+        dict: Counts of 'rows' read, 'parsable' reactions and 'templates' extracted
+            (records with a reaction SMARTS), including previous runs
+
+    Raises:
+        ValueError: if the checkpoint belongs to another input, or an output file
+            is missing or shorter than when the checkpoint was written
+    '''
+    if checkpoint_path is None:
+        checkpoint_path = templates_path + '.checkpoint'
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * processes
+
+    checkpoint = _read_checkpoint(checkpoint_path, input_path) if resume else None
+    if checkpoint is None:
+        checkpoint = {'input': os.path.abspath(input_path), 'rows': 0, 'parsable': 0,
+            'templates': 0, 'templates_size': 0, 'reactions_size': 0}
+    elif checkpoint['rows']:
+        print('Resuming after {} rows'.format(checkpoint['rows']))
+
+    templates_writer = _ChunkWriter(templates_path, checkpoint['templates_size'])
+    reactions_writer = _ChunkWriter(reactions_path, checkpoint['reactions_size']) \
+        if reactions_path is not None else None
+
+    def finish(chunk_rows, results):
+        templates_writer.write([template for (_, template) in results])
+        if reactions_writer is not None:
+            reactions_writer.write([reaction for (reaction, _) in results])
+        checkpoint['rows'] += chunk_rows
+        checkpoint['parsable'] += len(results)
+        checkpoint['templates'] += sum('reaction_smarts' in template for (_, template) in results)
+        checkpoint['templates_size'] = templates_writer.flush()
+        if reactions_writer is not None:
+            checkpoint['reactions_size'] = reactions_writer.flush()
+        _write_checkpoint(checkpoint_path, checkpoint)
+
+    # Skip the rows that are already done
+    reactions = read_reactions(input_path)
+    for _ in zip(range(checkpoint['rows']), reactions):
+        pass
+
+    try:
+        if processes == 1:
+            for chunk in _chunks(reactions, chunksize):
+                finish(len(chunk), extract_chunk(chunk))
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                pending = deque()
+                for chunk in _chunks(reactions, chunksize):
+                    pending.append((len(chunk), pool.apply_async(extract_chunk, (chunk,))))
+                    while len(pending) >= max_pending or (pending and pending[0][1].ready()):
+                        chunk_rows, result = pending.popleft()
+                        finish(chunk_rows, result.get())
+                while pending:
+                    chunk_rows, result = pending.popleft()
+                    finish(chunk_rows, result.get())
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        templates_writer.close()
+        if reactions_writer is not None:
+            reactions_writer.close()
+
+    return {key: checkpoint[key] for key in ('rows', 'parsable', 'templates')}
@@ -1,15 +1,29 @@
+import json
+import struct
+from collections import OrderedDict
+
 import rdkit.Chem as Chem
 import rdkit.Chem.AllChem as AllChem
+from rdkit.Chem.rdChemReactions import ChemicalReaction
 from rdkit.Chem.rdchem import ChiralType, BondType, BondDir, BondStereo
 
-from rdchiral.chiral import template_atom_could_have_been_tetra
-from rdchiral.utils import vprint, PLEVEL
+from rdchiral.chiral import template_atom_could_have_been_tetra, template_chirality_by_mapnum, \
+    molecule_chirality_by_mapnum
+from rdchiral import utils
+from rdchiral.utils import vprint
 from rdchiral.bonds import enumerate_possible_cistrans_defs, bond_dirs_by_mapnum, \
     get_atoms_across_double_bonds
 
 BondDirOpposite = {AllChem.BondDir.ENDUPRIGHT: AllChem.BondDir.ENDDOWNRIGHT,
                    AllChem.BondDir.ENDDOWNRIGHT: AllChem.BondDir.ENDUPRIGHT}
 
+# Binary layout of rdchiralReaction.to_bytes: magic, format version and the
+# lengths of the five blobs that follow (SMARTS, RDKit reaction, reactant
+# template, product template, JSON-encoded lookup tables)
+REACTION_BYTES_MAGIC = b'RDCR'
+REACTION_BYTES_VERSION = 1
+_reaction_bytes_header = struct.Struct('<4sH5I')
+
 class rdchiralReaction(object):
     '''Class to store everything that should be pre-computed for a reaction. This
     makes library application much faster, since we can pre-do a lot of work
@@ -19,22 +33,40 @@ class rdchiralReaction(object):
         reaction_smarts (str): reaction SMARTS string
         rxn (rdkit.Chem.rdChemReactions.ChemicalReaction): RDKit reaction object.
             Generated from `reaction_smarts` using `initialize_rxn_from_smarts`
+        reactant_queries (list): Query molecule for each reactant template of `rxn`,
+            with ring info and property caches initialized, for substructure matching
         template_r: Reaction reactant template fragments
         template_p: Reaction product template fragments
         atoms_rt_map (dict): Dictionary mapping from atom map number to RDKit Atom for reactants
         atoms_pt_map (dict): Dictionary mapping from atom map number to RDKit Atom for products
         atoms_rt_idx_to_map (dict): Dictionary mapping from atom idx to RDKit Atom for reactants
         atoms_pt_idx_to_map (dict): Dictionary mapping from atom idx to RDKit Atom for products
+        rt_chirality_by_mapnum (dict): Chirality of reactant template atoms by original
+            atom map number, from `template_chirality_by_mapnum`
+        rt_chirality_can_reject (bool): Whether any reactant template atom is chiral or
+            could have been, i.e., whether the chirality check can reject a match
+        rt_core_idx_mapnums (list): (atom idx, atom map number) of reactant template
+            atoms that also appear in the product template
+        max_products (int): Default maximum number of raw RunReactants outcomes
+            (None for RDKit's default)
+        max_outcomes (int): Default maximum number of unique outcomes (None for no limit)
 
     Args:
         reaction_smarts (str): Reaction SMARTS string
+        max_products (int, optional): Default maximum number of raw RunReactants outcomes
+        max_outcomes (int, optional): Default maximum number of unique outcomes
     '''
-    def __init__(self, reaction_smarts):
+    def __init__(self, reaction_smarts, max_products=None, max_outcomes=None):
         # Keep smarts, useful for reporting
         self.reaction_smarts = reaction_smarts
 
+        # Limits on enumeration, used when rdchiralRun is not given any
+        self.max_products = max_products
+        self.max_outcomes = max_outcomes
+
         # Initialize - assigns stereochemistry and fills in missing rct map numbers
         self.rxn = initialize_rxn_from_smarts(reaction_smarts)
+        self.reactant_queries = get_reactant_queries_from_rxn(self.rxn)
 
         # Combine template fragments so we can play around with mapnums
         self.template_r, self.template_p = get_template_frags_from_rxn(self.rxn)
@@ -60,6 +92,13 @@ class rdchiralReaction(object):
         [template_atom_could_have_been_tetra(a) for a in self.template_r.GetAtoms()]
         [template_atom_could_have_been_tetra(a) for a in self.template_p.GetAtoms()]
 
+        # Pre-list chirality of template atoms (for checking matches)
+        self.rt_chirality_by_mapnum = template_chirality_by_mapnum(self.template_r)
+        self.rt_chirality_can_reject = any(tag != ChiralType.CHI_UNSPECIFIED or tetra_possible
+            for (tag, tetra_possible, _) in self.rt_chirality_by_mapnum.values())
+        self.rt_core_idx_mapnums = [(idx, mapnum) for (idx, mapnum) in \
+            self.atoms_rt_idx_to_map.items() if mapnum in self.atoms_pt_map]
+
         # Pre-list chiral double bonds (for copying back into outcomes/matching)
         self.rt_bond_dirs_by_mapnum = bond_dirs_by_mapnum(self.template_r)
         self.pt_bond_dirs_by_mapnum = bond_dirs_by_mapnum(self.template_p)
@@ -69,12 +108,122 @@ class rdchiralReaction(object):
             enumerate_possible_cistrans_defs(self.template_r)
 
     def reset(self):
-        '''Reset atom map numbers for template fragment atoms'''
+        '''Reset atom map numbers for template fragment atoms
+
+        Running the reaction renumbers the template fragment atoms to match
+        each outcome. This is not needed before a run (every atom that is
+        renumbered is renumbered again for each outcome before it is used),
+        only to get the template fragments back as they were initialized.
+        '''
         for (idx, mapnum) in self.atoms_rt_idx_to_map.items():
             self.template_r.GetAtomWithIdx(idx).SetAtomMapNum(mapnum)
         for (idx, mapnum) in self.atoms_pt_idx_to_map.items():
             self.template_p.GetAtomWithIdx(idx).SetAtomMapNum(mapnum)
 
+    def to_bytes(self):
+        '''Serialize the initialized reaction, see `from_bytes`
+
+        The RDKit reaction and template fragments are stored as RDKit binaries
+        including all atom/bond properties (e.g., tetra_possible), and the
+        pre-computed bond direction tables are stored alongside them.
+
+        Returns:
+            bytes: serialized reaction
+        '''
+        # Store the template fragments with their original map numbers
+        self.reset()
+        props = Chem.PropertyPickleOptions.AllProps
+        blobs = [
+            self.reaction_smarts.encode('utf-8'),
+            self.rxn.ToBinary(props),
+            self.template_r.ToBinary(props),
+            self.template_p.ToBinary(props),
+            json.dumps({
+                'atoms_rt_idx_to_map': [self.atoms_rt_idx_to_map[i] for i in range(len(self.atoms_rt_idx_to_map))],
+                'atoms_pt_idx_to_map': [self.atoms_pt_idx_to_map[i] for i in range(len(self.atoms_pt_idx_to_map))],
+                'rt_bond_dirs_by_mapnum': [[i, j, int(d)] for ((i, j), d) in self.rt_bond_dirs_by_mapnum.items()],
+                'pt_bond_dirs_by_mapnum': [[i, j, int(d)] for ((i, j), d) in self.pt_bond_dirs_by_mapnum.items()],
+                'required_rt_bond_defs': [list(k) + [int(d1), int(d2)] for (k, (d1, d2)) in self.required_rt_bond_defs.items()],
+                'required_bond_defs_coreatoms': [list(k) for k in self.required_bond_defs_coreatoms],
+                'max_products': self.max_products,
+                'max_outcomes': self.max_outcomes,
+            }).encode('utf-8'),
+        ]
+        header = _reaction_bytes_header.pack(REACTION_BYTES_MAGIC, REACTION_BYTES_VERSION,
+            *[len(blob) for blob in blobs])
+        return header + b''.join(blobs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Load a reaction serialized with `to_bytes`
+
+        This does not re-run `initialize_rxn_from_smarts` or
+        `enumerate_possible_cistrans_defs`, so it is much faster than
+        initializing from the reaction SMARTS.
+
+        Args:
+            data (bytes): serialized reaction (any bytes-like object)
+
+        Returns:
+            rdchiralReaction: initialized reaction
+        '''
+        data = memoryview(data)
+        magic, version, *lengths = _reaction_bytes_header.unpack_from(data)
+        if magic != REACTION_BYTES_MAGIC or version != REACTION_BYTES_VERSION:
+            raise ValueError('Not a serialized rdchiralReaction (version {})'.format(REACTION_BYTES_VERSION))
+        blobs = []
+        start = _reaction_bytes_header.size
+        for length in lengths:
+            blobs.append(bytes(data[start:start + length]))
+            start += length
+        tables = json.loads(blobs[4].decode('utf-8'))
+
+        self = cls.__new__(cls)
+        self.reaction_smarts = blobs[0].decode('utf-8')
+        self.max_products = tables.get('max_products')
+        self.max_outcomes = tables.get('max_outcomes')
+        self.rxn = ChemicalReaction(blobs[1])
+        self.reactant_queries = get_reactant_queries_from_rxn(self.rxn)
+        self.template_r = Chem.Mol(blobs[2])
+        self.template_p = Chem.Mol(blobs[3])
+        self.atoms_rt_idx_to_map = dict(enumerate(tables['atoms_rt_idx_to_map']))
+        self.atoms_pt_idx_to_map = dict(enumerate(tables['atoms_pt_idx_to_map']))
+        self.atoms_rt_map = {a.GetAtomMapNum(): a \
+            for a in self.template_r.GetAtoms() if a.GetAtomMapNum()}
+        self.atoms_pt_map = {a.GetAtomMapNum(): a \
+            for a in self.template_p.GetAtoms() if a.GetAtomMapNum()}
+        self.rt_bond_dirs_by_mapnum = {(i, j): BondDir.values[d]
+            for (i, j, d) in tables['rt_bond_dirs_by_mapnum']}
+        self.pt_bond_dirs_by_mapnum = {(i, j): BondDir.values[d]
+            for (i, j, d) in tables['pt_bond_dirs_by_mapnum']}
+        self.required_rt_bond_defs = {tuple(v[:4]): (BondDir.values[v[4]], BondDir.values[v[5]])
+            for v in tables['required_rt_bond_defs']}
+        self.required_bond_defs_coreatoms = set(tuple(k) for k in tables['required_bond_defs_coreatoms'])
+        self.rt_chirality_by_mapnum = template_chirality_by_mapnum(self.template_r)
+        self.rt_chirality_can_reject = any(tag != ChiralType.CHI_UNSPECIFIED or tetra_possible
+            for (tag, tetra_possible, _) in self.rt_chirality_by_mapnum.values())
+        self.rt_core_idx_mapnums = [(idx, mapnum) for (idx, mapnum) in \
+            self.atoms_rt_idx_to_map.items() if mapnum in self.atoms_pt_map]
+        return self
+
+    @staticmethod
+    def smarts_from_bytes(data):
+        '''Read only the reaction SMARTS from a reaction serialized with `to_bytes`
+
+        Args:
+            data (bytes): serialized reaction (any bytes-like object)
+
+        Returns:
+            str: reaction SMARTS
+        '''
+        length = _reaction_bytes_header.unpack_from(data)[2]
+        start = _reaction_bytes_header.size
+        return bytes(data[start:start + length]).decode('utf-8')
+
+    def __reduce__(self):
+        # Pickle through the binary format, RDKit objects are not picklable with their props
+        return (self.__class__.from_bytes, (self.to_bytes(),))
+
 class rdchiralReactants(object):
     '''Class to store everything that should be pre-computed for a reactant mol
     so that library application is faster
@@ -89,6 +238,8 @@ class rdchiralReactants(object):
             (int, int, rdkit.Chem.rdchem.Bond)
         bond_dirs_by_mapnum (dict): Dictionary mapping from atom map number tuples to BondDir
         atoms_across_double_bonds (list): List of cis/trans specifications from `get_atoms_across_double_bonds`
+        chirality_by_mapnum (dict): Chirality of (possibly) tetrahedral atoms by atom
+            map number, from `molecule_chirality_by_mapnum`
 
     Args:
         reactant_smiles (str): Reactant SMILES string
@@ -107,7 +258,9 @@ class rdchiralReactants(object):
 
         # Create copy of molecule without chiral information, used with
         # RDKit's naive runReactants
-        self.reactants_achiral = initialize_reactants_from_smiles(reactant_smiles)
+        # note: copying keeps map numbers, stereo flags and the property cache
+        # from initialization, so the SMILES does not need to be parsed again
+        self.reactants_achiral = Chem.Mol(self.reactants)
         [a.SetChiralTag(ChiralType.CHI_UNSPECIFIED) for a in self.reactants_achiral.GetAtoms()]
         [(b.SetStereo(BondStereo.STEREONONE), b.SetBondDir(BondDir.NONE)) \
             for b in self.reactants_achiral.GetBonds()]
@@ -128,6 +281,98 @@ class rdchiralReactants(object):
         # Get atoms across double bonds defined by mapnum
         self.atoms_across_double_bonds = get_atoms_across_double_bonds(self.reactants)
 
+        # Pre-list chirality of tetrahedral atoms (for checking template matches)
+        self.chirality_by_mapnum = molecule_chirality_by_mapnum(self.reactants)
+
+class rdchiralReactantsCache(object):
+    '''Bounded least-recently-used cache of rdchiralReactants, keyed by SMILES
+
+    rdchiralRun does not modify reactants, so an initialized rdchiralReactants
+    can be reused whenever the same molecule comes up again (e.g., recurring
+    intermediates in a tree search).
+
+    By default, entries are keyed by RDKit canonical SMILES and initialized from
+    that canonical SMILES, so every spelling of a molecule shares one entry.
+    Atom map numbers, and hence mapped outcomes and `atoms_changed`, then follow
+    the canonical atom order rather than the order of the SMILES passed to `get`.
+
+    Attributes:
+        maxsize (int): Maximum number of cached reactants
+        canonicalize (bool): Whether keys are RDKit canonical SMILES
+        hits (int): Number of lookups served from the cache
+        misses (int): Number of lookups that initialized new reactants
+        evictions (int): Number of reactants dropped to stay within `maxsize`
+
+    Args:
+        maxsize (int): Maximum number of cached reactants
+        canonicalize (bool): Key and initialize entries by RDKit canonical SMILES.
+            This costs one SMILES parse per lookup. If False, the input SMILES
+            itself is the key, so atom maps follow the caller's atom order but
+            different spellings of a molecule get separate entries
+    '''
+    def __init__(self, maxsize=1024, canonicalize=True):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.canonicalize = canonicalize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, reactant_smiles):
+        if not self.canonicalize:
+            return reactant_smiles
+        mol = Chem.MolFromSmiles(reactant_smiles)
+        if mol is None:
+            return reactant_smiles
+        return Chem.MolToSmiles(mol, True)
+
+    def get(self, reactant_smiles):
+        '''Get initialized reactants, initializing and caching them if needed
+
+        Args:
+            reactant_smiles (str): Reactant SMILES string
+
+        Returns:
+            rdchiralReactants: initialized reactants
+        '''
+        key = self._key(reactant_smiles)
+        reactants = self._cache.get(key)
+        if reactants is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return reactants
+
+        self.misses += 1
+        reactants = rdchiralReactants(key)
+        self._cache[key] = reactants
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+        return reactants
+
+    def clear(self):
+        '''Drop all cached reactants (statistics are kept)'''
+        self._cache.clear()
+
+    def stats(self):
+        '''Cache statistics
+
+        Returns:
+            dict: size, maxsize, hits, misses and evictions
+        '''
+        return {
+            'size': len(self._cache),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
 
 def initialize_rxn_from_smarts(reaction_smarts):
     '''Initialize RDKit reaction object from SMARTS string
@@ -143,7 +388,7 @@ def initialize_rxn_from_smarts(reaction_smarts):
     rxn.Initialize()
     if rxn.Validate()[1] != 0:
         raise ValueError('validation failed')
-    if PLEVEL >= 2: print('Validated rxn without errors')
+    if utils.TRACER is not None: utils.TRACER(2, 'template_validated')
 
 
     # Figure out if there are unnecessary atom map numbers (that are not balanced)
@@ -161,7 +406,7 @@ def initialize_rxn_from_smarts(reaction_smarts):
             if not a.GetAtomMapNum() or a.GetAtomMapNum() not in prd_maps:
                 a.SetAtomMapNum(unmapped)
                 unmapped += 1
-    if PLEVEL >= 2: print('Added {} map nums to unmapped reactants'.format(unmapped-700))
+    if utils.TRACER is not None: utils.TRACER(2, 'template_map_numbers_added', added=unmapped-700)
     if unmapped > 800:
         raise ValueError('Why do you have so many unmapped atoms in the template reactants?')
 
@@ -186,9 +431,29 @@ def initialize_reactants_from_smiles(reactant_smiles):
     # need to populate the map number field, since this field
     # gets copied over during the reaction via reactant_atom_idx.
     [a.SetAtomMapNum(i+1) for (i, a) in enumerate(reactants.GetAtoms())]
-    if PLEVEL >= 2: print('Initialized reactants, assigned map numbers, stereochem, flagpossiblestereocenters')
+    if utils.TRACER is not None: utils.TRACER(2, 'reactants_initialized', smiles=reactant_smiles)
     return reactants
 
+def get_reactant_queries_from_rxn(rxn):
+    '''Get query molecules for the reactant templates of an RDKit reaction object
+
+    The queries are copies with their ring info and property caches initialized,
+    so that substructure matching does not redo this work for every molecule.
+
+    Args:
+        rxn (rdkit.Chem.rdChemReactions.ChemicalReaction): RDKit reaction object
+
+    Returns:
+        list: RDKit query molecule for each reactant template
+    '''
+    queries = []
+    for rct in rxn.GetReactants():
+        query = Chem.Mol(rct)
+        query.UpdatePropertyCache(strict=False)
+        Chem.FastFindRings(query)
+        queries.append(query)
+    return queries
+
 def get_template_frags_from_rxn(rxn):
     '''Get template fragments from RDKit reaction object
 
@@ -199,14 +464,17 @@ def get_template_frags_from_rxn(rxn):
         (rdkit.Chem.rdchem.Mol, rdkit.Chem.rdchem.Mol): tuple of fragment molecules
     '''
     # Copy reaction template so we can play around with map numbers
+    # note: always take a copy, even for single-fragment templates, so that
+    # renumbering template atoms during a run never leaks back into the
+    # templates RDKit uses for RunReactants
     for i, rct in enumerate(rxn.GetReactants()):
         if i == 0:
-            template_r = rct
+            template_r = Chem.Mol(rct)
         else:
             template_r = AllChem.CombineMols(template_r, rct)
     for i, prd in enumerate(rxn.GetProducts()):
         if i == 0:
-            template_p = prd
+            template_p = Chem.Mol(prd)
         else:
             template_p = AllChem.CombineMols(template_p, prd)
     return template_r, template_p
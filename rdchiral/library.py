@@ -0,0 +1,366 @@
+from __future__ import print_function
+import json
+import multiprocessing
+from functools import partial
+from time import perf_counter
+
+import rdkit.Chem as Chem
+from rdkit import DataStructs
+
+from rdchiral import utils
+from rdchiral.initialization import rdchiralReaction, rdchiralReactants, rdchiralReactantsCache
+from rdchiral.main import _rdchiralRun
+from rdchiral.template_store import TemplateStore
+
+'''
+This file contains a template library for applying many templates to a single
+molecule, which is the typical use case for one-step retrosynthesis.
+
+Templates are initialized once, when the library is built. When expanding a
+molecule, templates are grouped by their reactant-side SMARTS: each distinct
+reactant side is checked once against the (achiral) reactants with a plain
+substructure match, and templates whose reactant side does not match are never
+handed to RunReactants.
+
+Before the substructure match, each reactant side is screened with RDKit pattern
+fingerprints: if a bit set in the template's fingerprint is not set in the
+molecule's fingerprint, the template cannot match. Fingerprints are stored as
+Python ints so the screen is a single bitwise test. The index can be saved
+next to the template library and loaded instead of being rebuilt.
+
+A library can also be backed by a TemplateStore (see `TemplateLibrary.from_store`),
+in which case templates are only deserialized once they pass the pre-screen.
+
+Many molecules can be expanded in parallel with `TemplateLibrary.expand_many`.
+Worker processes hold their own initialized library for their whole lifetime:
+with the 'fork' start method they inherit the parent's library directly,
+otherwise they rebuild it once in the pool initializer. Only SMILES strings go
+to the workers and only outcome lists come back.
+'''
+
+# Library used by the current worker process of `TemplateLibrary.expand_many`
+_worker_library = None
+
+def _init_worker(templates, fp_size, query_fps, store_path, cache_args):
+    '''Pool initializer, builds the worker's library once'''
+    global _worker_library
+    reactions = TemplateStore(store_path) if store_path is not None else None
+    reactants_cache = rdchiralReactantsCache(*cache_args) if cache_args is not None else None
+    _worker_library = TemplateLibrary(templates, fp_size=fp_size, reactions=reactions,
+        reactants_cache=reactants_cache)
+    _worker_library.query_fps = query_fps
+
+def _expand_in_worker(reactant_smiles, **kwargs):
+    '''Pool task, expands one molecule with the worker's library'''
+    return _worker_library.expand(reactant_smiles, **kwargs)
+
+def pattern_fingerprint(mol, fp_size=2048):
+    '''Pattern fingerprint of a molecule (or query molecule) as an int
+
+    Args:
+        mol (rdkit.Chem.rdchem.Mol): RDKit molecule or query molecule
+        fp_size (int): Number of bits in the fingerprint
+
+    Returns:
+        int: fingerprint, with one bit per fingerprint bit
+    '''
+    return int(DataStructs.BitVectToText(Chem.PatternFingerprint(mol, fpSize=fp_size)), 2)
+
+class TemplateLibrary(object):
+    '''Class to store a set of pre-initialized templates that are applied together
+
+    Attributes:
+        templates (list): List of template records (dict) with keys 'template_id',
+            'reaction_smarts' and 'score', in library order
+        reactions (list): rdchiralReaction for each template, or None if the template
+            could not be initialized or cannot be applied to a single molecule.
+            This is the `reactions` argument as-is when one is given
+        queries (list): RDKit query molecule for each distinct reactant side
+            (None until first needed when `reactions` is given)
+        query_smarts (list): Reactant-side SMARTS for each entry in `queries`
+        query_idx (list): Index into `queries` for each template (None if unusable)
+        query_fps (list): Pattern fingerprint (int) for each entry in `queries`,
+            None until the index is built or loaded
+        fp_size (int): Number of bits in the pattern fingerprints
+        reactants_cache (rdchiralReactantsCache): Cache used for SMILES passed to `expand`
+
+    Args:
+        templates (iterable): Reaction SMARTS strings, or dicts with a 'reaction_smarts'
+            key and optionally a 'template_id' (or '_id' or 'reaction_id') and a 'score',
+            such as the templates returned by `template_extractor.extract_from_reaction`
+        index_path (str, optional): Pre-screen index written by `save_index` to load
+            instead of computing fingerprints
+        fp_size (int): Number of bits in the pattern fingerprints
+        reactions (sequence, optional): Already initialized rdchiralReaction objects,
+            one per template, e.g. a TemplateStore. They are only accessed when needed
+        reactants_cache (rdchiralReactantsCache, optional): Cache to look up reactants
+            in when `expand` is given SMILES strings
+    '''
+    def __init__(self, templates, index_path=None, fp_size=2048, reactions=None,
+            reactants_cache=None):
+        self.templates = []
+        self.reactions = [] if reactions is None else reactions
+        self.queries = []
+        self.query_smarts = []
+        self.query_idx = []
+        self.query_fps = None
+        self.fp_size = fp_size
+        self.reactants_cache = reactants_cache
+        # Template used to build each query
+        self._query_template = []
+        query_by_smarts = {}
+
+        for i, template in enumerate(templates):
+            if isinstance(template, dict):
+                record = {
+                    'template_id': template.get('template_id',
+                        template.get('_id', template.get('reaction_id', i))),
+                    'reaction_smarts': template['reaction_smarts'],
+                    'score': template.get('score'),
+                }
+            else:
+                record = {'template_id': i, 'reaction_smarts': template, 'score': None}
+            self.templates.append(record)
+
+            if reactions is None:
+                try:
+                    rxn = rdchiralReaction(record['reaction_smarts'])
+                except ValueError as e:
+                    if utils.TRACER is not None: utils.TRACER(1, 'template_skipped',
+                        template_id=record['template_id'], error=str(e))
+                    rxn = None
+                if rxn is not None and rxn.rxn.GetNumReactantTemplates() != 1:
+                    # rdchiralRun applies templates to a single reactant molecule
+                    if utils.TRACER is not None: utils.TRACER(1, 'template_skipped',
+                        template_id=record['template_id'], error='multiple reactant templates')
+                    rxn = None
+                self.reactions.append(rxn)
+                if rxn is None:
+                    self.query_idx.append(None)
+                    continue
+
+            # Templates sharing a reactant side share a single substructure check
+            reactant_smarts = record['reaction_smarts'].split('>')[0]
+            if reactant_smarts not in query_by_smarts:
+                query_by_smarts[reactant_smarts] = len(self.queries)
+                self.queries.append(None if reactions is not None else
+                    self.reactions[i].reactant_queries[0])
+                self.query_smarts.append(reactant_smarts)
+                self._query_template.append(i)
+            self.query_idx.append(query_by_smarts[reactant_smarts])
+
+        if reactions is not None and len(reactions) != len(self.templates):
+            raise ValueError('Expected one reaction per template')
+
+        if utils.TRACER is not None: utils.TRACER(1, 'library_initialized', templates=len(self.templates),
+            queries=len(self.queries))
+
+        if index_path is not None:
+            self.load_index(index_path)
+
+    @classmethod
+    def from_store(cls, store, templates=None, index_path=None, fp_size=2048,
+            reactants_cache=None):
+        '''Build a library backed by a template cache, see `template_store`
+
+        Args:
+            store (TemplateStore or str): Template store, or path to a cache file
+            templates (iterable, optional): Template records as for `TemplateLibrary`,
+                aligned with the store. Defaults to the reaction SMARTS in the store
+            index_path (str, optional): Pre-screen index written by `save_index`
+            fp_size (int): Number of bits in the pattern fingerprints
+            reactants_cache (rdchiralReactantsCache, optional): see `TemplateLibrary`
+
+        Returns:
+            TemplateLibrary: library that deserializes templates on first use
+        '''
+        if not isinstance(store, TemplateStore):
+            store = TemplateStore(store)
+        if templates is None:
+            templates = [store.reaction_smarts(i) for i in range(len(store))]
+        return cls(templates, index_path=index_path, fp_size=fp_size, reactions=store,
+            reactants_cache=reactants_cache)
+
+    def __len__(self):
+        return len(self.templates)
+
+    def get_query(self, j):
+        '''Query molecule for reactant side j, built on first use'''
+        if self.queries[j] is None:
+            self.queries[j] = self.reactions[self._query_template[j]].reactant_queries[0]
+        return self.queries[j]
+
+    def build_index(self):
+        '''Compute the pattern fingerprint pre-screen index for all reactant sides
+
+        Templates in a TemplateStore are deserialized one at a time for this and
+        dropped again, so building the index does not load the whole library.
+        '''
+        query_fps = []
+        for j in range(len(self.queries)):
+            query = self.queries[j]
+            if query is None:
+                if isinstance(self.reactions, TemplateStore):
+                    query = self.reactions.load(self._query_template[j]).reactant_queries[0]
+                else:
+                    query = self.get_query(j)
+            query_fps.append(pattern_fingerprint(query, self.fp_size))
+        self.query_fps = query_fps
+
+    def save_index(self, path):
+        '''Write the pre-screen index to a JSON file
+
+        Args:
+            path (str): Output file path
+        '''
+        if self.query_fps is None:
+            self.build_index()
+        with open(path, 'w') as fid:
+            json.dump({
+                'fp_size': self.fp_size,
+                'query_smarts': self.query_smarts,
+                'query_fps': ['{:x}'.format(fp) for fp in self.query_fps],
+            }, fid)
+
+    def load_index(self, path):
+        '''Load a pre-screen index written by `save_index`
+
+        Args:
+            path (str): Index file path
+
+        Raises:
+            ValueError: if the index was built for a different set of templates
+        '''
+        with open(path, 'r') as fid:
+            index = json.load(fid)
+        if index['query_smarts'] != self.query_smarts:
+            raise ValueError('Pre-screen index does not match the templates in this library')
+        self.fp_size = index['fp_size']
+        self.query_fps = [int(fp, 16) for fp in index['query_fps']]
+
+    def expand(self, reactants, keep_mapnums=False, combine_enantiomers=True, return_mapped=False,
+            return_outcomes=False, max_products=None, max_outcomes=None, time_budget_ms=None,
+            stats=None):
+        '''Apply all templates in the library to one set of reactants
+
+        Args:
+            reactants (rdchiralReactants or str): reactants to expand, SMILES strings
+                are initialized on the fly (or taken from `reactants_cache`)
+            keep_mapnums (bool): Whether to keep map numbers or not
+            combine_enantiomers (bool): Whether to combine enantiomers
+            return_mapped (bool): Whether to additionally return atom mapped SMILES strings
+            return_outcomes (bool): Whether outcomes are rdchiralOutcome handles
+                instead of SMILES strings, see `rdchiralRun`
+            max_products (int, optional): Maximum number of raw outcomes per template,
+                see `rdchiralRun`
+            max_outcomes (int, optional): Maximum number of unique outcomes per
+                template, see `rdchiralRun`
+            time_budget_ms (float, optional): Wall-clock time budget in milliseconds
+                for the whole expansion, checked between templates and between
+                outcomes of a template
+            stats (rdchiralStats, optional): Accumulates time spent in each phase of
+                rdchiralRun, see `rdchiral.stats`
+
+        Returns:
+            list: One dict per template with at least one outcome, in library order,
+                with keys 'template_id', 'score' and 'outcomes' (plus 'mapped_outcomes'
+                if `return_mapped` is True). If `time_budget_ms` is given, returns a
+                tuple of this list and whether it was truncated
+        '''
+        deadline = None if time_budget_ms is None else perf_counter() + time_budget_ms / 1000.
+        truncated = False
+        if isinstance(reactants, str):
+            if self.reactants_cache is not None:
+                reactants = self.reactants_cache.get(reactants)
+            else:
+                reactants = rdchiralReactants(reactants)
+        if self.query_fps is None:
+            self.build_index()
+
+        # Each distinct reactant side is screened and matched at most once
+        fp = pattern_fingerprint(reactants.reactants_achiral, self.fp_size)
+        query_matches = [None] * len(self.queries)
+
+        results = []
+        for i, j in enumerate(self.query_idx):
+            if deadline is not None and perf_counter() >= deadline:
+                truncated = True
+                break
+            if j is None:
+                continue
+            if query_matches[j] is None:
+                query_fp = self.query_fps[j]
+                query_matches[j] = (query_fp & fp) == query_fp and \
+                    reactants.reactants_achiral.HasSubstructMatch(self.get_query(j))
+            if not query_matches[j]:
+                continue
+
+            rxn = self.reactions[i]
+            if rxn.rxn.GetNumReactantTemplates() != 1:
+                # only possible for stored templates, which are not checked up front
+                continue
+
+            outcomes = _rdchiralRun(rxn, reactants, keep_mapnums=keep_mapnums,
+                combine_enantiomers=combine_enantiomers, return_mapped=return_mapped,
+                return_outcomes=return_outcomes, max_products=max_products,
+                max_outcomes=max_outcomes, deadline=deadline, stats=stats)
+            if deadline is not None:
+                # strip the trailing truncated flag
+                truncated = outcomes[-1]
+                outcomes = outcomes[0] if len(outcomes) == 2 else outcomes[:2]
+            if return_mapped and outcomes and not return_outcomes:
+                outcomes, mapped_outcomes = outcomes
+            if not outcomes:
+                continue
+
+            result = {
+                'template_id': self.templates[i]['template_id'],
+                'score': self.templates[i]['score'],
+                'outcomes': outcomes,
+            }
+            if return_mapped and not return_outcomes:
+                result['mapped_outcomes'] = mapped_outcomes
+            results.append(result)
+            if truncated:
+                break
+        if deadline is not None:
+            return results, truncated
+        return results
+
+    def expand_many(self, reactant_smiles_iterable, processes=None, chunksize=16, **kwargs):
+        '''Expand many molecules in parallel, see `expand`
+
+        Args:
+            reactant_smiles_iterable (iterable): Reactant SMILES strings
+            processes (int, optional): Number of worker processes, defaults to the
+                number of CPUs
+            chunksize (int): Number of molecules sent to a worker at a time
+            **kwargs: passed through to `expand`
+
+        Yields:
+            list: Output of `expand` for each molecule, in input order
+        '''
+        global _worker_library
+        if self.query_fps is None:
+            self.build_index()
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # Workers inherit this library as-is, nothing is pickled or re-initialized
+            context = multiprocessing.get_context('fork')
+            initializer, initargs = None, ()
+            _worker_library = self
+        else:
+            # Workers re-open the same template store, or rebuild from SMARTS
+            context = multiprocessing.get_context()
+            store_path = self.reactions.path if isinstance(self.reactions, TemplateStore) else None
+            cache_args = None if self.reactants_cache is None else \
+                (self.reactants_cache.maxsize, self.reactants_cache.canonicalize)
+            initializer = _init_worker
+            initargs = (self.templates, self.fp_size, self.query_fps, store_path, cache_args)
+
+        try:
+            with context.Pool(processes, initializer=initializer, initargs=initargs) as pool:
+                for results in pool.imap(partial(_expand_in_worker, **kwargs),
+                        reactant_smiles_iterable, chunksize=chunksize):
+                    yield results
+        finally:
+            _worker_library = None
@@ -3,17 +3,21 @@ import sys
 import os
 import re
 import copy
+from time import perf_counter
 
 import rdkit.Chem as Chem
 import rdkit.Chem.AllChem as AllChem
 from rdkit.Chem.rdchem import ChiralType, BondType, BondDir
 
-from rdchiral.utils import vprint, PLEVEL, atoms_are_different
+from rdchiral import utils
+from rdchiral.utils import vprint, atoms_are_different
 from rdchiral.initialization import rdchiralReaction, rdchiralReactants
 from rdchiral.chiral import template_atom_could_have_been_tetra, copy_chirality,\
-    atom_chirality_matches
-from rdchiral.clean import canonicalize_outcome_smiles, combine_enantiomers_into_racemic
-from rdchiral.bonds import BondDirOpposite, restore_bond_stereo_to_sp2_atom
+    atom_chirality_matches, check_template_chirality
+from rdchiral.clean import canonicalize_outcome_smiles, combine_enantiomers_into_racemic, \
+    rdchiralOutcome
+from rdchiral.bonds import BondDirOpposite, restore_bond_stereo_to_sp2_atom, \
+    check_template_bond_dirs
 
 '''
 This file contains the main functions for running reactions. 
@@ -93,7 +97,9 @@ def rdchiralRunText(reaction_smarts, reactant_smiles, **kwargs):
     reactants = rdchiralReactants(reactant_smiles)
     return rdchiralRun(rxn, reactants, **kwargs)
 
-def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, return_mapped=False):
+def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, return_mapped=False,
+        return_outcomes=False, max_products=None, max_outcomes=None, time_budget_ms=None,
+        stats=None):
     '''Run rdchiral reaction
 
     NOTE: there is a fair amount of initialization (assigning stereochem), most
@@ -106,21 +112,141 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
         keep_mapnums (bool): Whether to keep map numbers or not
         combine_enantiomers (bool): Whether to combine enantiomers
         return_mapped (bool): Whether to additionally return atom mapped SMILES strings
+        return_outcomes (bool): Whether to return rdchiralOutcome handles instead of
+            SMILES strings. Handles hold the outcome molecules and only generate
+            SMILES when asked for them; they are neither deduplicated nor
+            combined into racemic outcomes (`combine_enantiomers` and
+            `return_mapped` are ignored)
+        max_products (int, optional): Maximum number of raw outcomes generated by
+            RunReactants. Defaults to `rxn.max_products`, or RDKit's default
+        max_outcomes (int, optional): Stop once this many unique outcomes have
+            been found (counted before combining enantiomers). With
+            `return_outcomes`, handles are counted instead, and those are not
+            deduplicated by SMILES. Defaults to `rxn.max_outcomes`, or no limit
+        time_budget_ms (float, optional): Wall-clock time budget in milliseconds.
+            It is checked before the run and between outcomes, and the outcomes
+            found so far are returned once it is exceeded
+        stats (rdchiralStats, optional): Accumulates time spent in each phase of
+            the run and counts of what happened to the outcomes, including why
+            raw outcomes were rejected, per template (see `rdchiral.stats`)
 
     Returns:
-        (list, str (optional)): Returns list of outcomes. If `return_mapped` is True,
-            additionally return atom mapped SMILES strings
+        (list, str (optional), bool (optional)): Returns list of outcomes. If `return_mapped`
+            is True, additionally return atom mapped SMILES strings. If `time_budget_ms`
+            is given, additionally return whether the outcomes were truncated
     '''
 
-    # New: reset atom map numbers for templates in case they have been overwritten
-    # by previous uses of this template!
-    rxn.reset()
+    # note: the template is not reset, map numbers left behind in the template
+    # fragments by a previous run are overwritten before they are used
+    return _rdchiralRun(rxn, reactants, keep_mapnums=keep_mapnums,
+        combine_enantiomers=combine_enantiomers, return_mapped=return_mapped,
+        return_outcomes=return_outcomes, max_products=max_products, max_outcomes=max_outcomes,
+        time_budget_ms=time_budget_ms, stats=stats)
+
+def rdchiralRunBatch(rxn, reactants_iterable, **kwargs):
+    '''Run one rdchiral reaction over many reactant molecules
+
+    Results are yielded as they are produced, so a large set of molecules can be streamed
+    through a single template without building intermediate lists.
+
+    Args:
+        rxn (rdchiralReaction): (rdkit reaction + auxilliary information)
+        reactants_iterable (iterable): rdchiralReactants objects or SMILES strings,
+            which will be initialized on the fly
+        **kwargs: passed through to `rdchiralRun`
+
+    Yields:
+        (list, str (optional)): Output of `rdchiralRun` for each reactant, in input order
+    '''
+    for reactants in reactants_iterable:
+        if isinstance(reactants, str):
+            reactants = rdchiralReactants(reactants)
+        yield _rdchiralRun(rxn, reactants, **kwargs)
+
+def _all_matches_rejected(rxn, reactants, max_matches=1000, tracer=None):
+    '''Decide from the raw substructure matches whether every outcome would be rejected
+
+    Every outcome of RunReactants for a single-reactant template comes from one
+    (non-uniquified) match of the reactant template, and whether it passes the
+    tetrahedral and double bond checks only depends on that match. If none of
+    the matches passes, no outcome can.
+
+    Args:
+        rxn (rdchiralReaction): (rdkit reaction + auxilliary information)
+        reactants (rdchiralReactants): (rdkit mol + auxilliary information)
+        max_matches (int): Give up (return False) when there are this many matches
+        tracer (callable, optional): Tracer to report the rejection to
+
+    Returns:
+        bool: True if there are matches, but all of them would be rejected
+    '''
+    if rxn.rxn.GetNumReactantTemplates() != 1:
+        return False
+    if not (rxn.rt_chirality_can_reject and reactants.chirality_by_mapnum) and \
+            not (reactants.atoms_across_double_bonds and rxn.required_rt_bond_defs):
+        return False # nothing that could rule out a match
+
+    matches = reactants.reactants_achiral.GetSubstructMatches(rxn.reactant_queries[0],
+        uniquify=False, maxMatches=max_matches)
+    if not matches or len(matches) >= max_matches:
+        return False
+    idx_to_mapnum = reactants.idx_to_mapnum
+    for match in matches:
+        atoms_rt_old = {idx_to_mapnum(match[idx]): mapnum for (idx, mapnum) in rxn.rt_core_idx_mapnums}
+        if check_template_chirality(atoms_rt_old, rxn.rt_chirality_by_mapnum,
+                reactants.chirality_by_mapnum) is None and \
+                check_template_bond_dirs(atoms_rt_old, reactants.atoms_across_double_bonds,
+                rxn.required_rt_bond_defs):
+            return False
+    if tracer is not None:
+        tracer(1, 'all_matches_rejected', matches=len(matches), template=rxn.reaction_smarts)
+    return True
+
+def _rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, return_mapped=False,
+        return_outcomes=False, max_products=None, max_outcomes=None, time_budget_ms=None,
+        deadline=None, stats=None):
+    '''Run rdchiral reaction, see `rdchiralRun`
+
+    The time budget can also be given as a `deadline` on the `time.perf_counter`
+    clock, shared between several calls.
+    '''
+    if max_products is None:
+        max_products = rxn.max_products
+    if max_outcomes is None:
+        max_outcomes = rxn.max_outcomes
+    return_truncated = time_budget_ms is not None or deadline is not None
+    if time_budget_ms is not None:
+        budget_deadline = perf_counter() + time_budget_ms / 1000.
+        deadline = budget_deadline if deadline is None else min(deadline, budget_deadline)
+    truncated = False
+    # events are reported to the stats object too, so that it can count them
+    tracer = utils.TRACER
+    report = tracer if stats is None else stats.tracer(tracer)
+    if deadline is not None and perf_counter() >= deadline:
+        # no time left to start
+        if report is not None: report(1, 'time_budget_exceeded', template=rxn.reaction_smarts)
+        if return_mapped and not return_outcomes:
+            return [], {}, True
+        return [], True
 
     ###############################################################################
     # Run naive RDKit on ACHIRAL version of molecules
-    outcomes = rxn.rxn.RunReactants((reactants.reactants_achiral,))
-    if PLEVEL >= (1): print('Using naive RunReactants, {} outcomes'.format(len(outcomes)))
-    if not outcomes:
+    # note: when stereochemistry could rule out matches, first check the raw matches,
+    #       so that RDKit does not build products that would all be rejected below
+    if stats is not None: t0 = perf_counter()
+    all_rejected = _all_matches_rejected(rxn, reactants, tracer=report)
+    if stats is not None: t0 = stats.lap('prefilter', t0)
+    if all_rejected:
+        outcomes = ()
+    else:
+        if max_products is None:
+            outcomes = rxn.rxn.RunReactants((reactants.reactants_achiral,))
+        else:
+            outcomes = rxn.rxn.RunReactants((reactants.reactants_achiral,), max_products)
+        if stats is not None: stats.lap('run_reactants', t0)
+    if report is not None: report(1, 'run_reactants', outcomes=len(outcomes), template=rxn.reaction_smarts)
+    if not outcomes and not return_truncated:
+        if report is not None: report(1, 'outcomes', outcomes=0, template=rxn.reaction_smarts)
         return []
     ###############################################################################
     
@@ -130,6 +256,95 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
 
     final_outcomes = set()
     mapped_outcomes = {}
+    outcome_handles = []
+    ###############################################################################
+
+
+    # Outcomes are checked and corrected one at a time, so that we can stop as
+    # soon as we have enough of them
+    for generated in _generate_outcomes(rxn, reactants, outcomes, keep_mapnums=keep_mapnums,
+            defer_mapped=return_outcomes, deadline=deadline, stats=stats):
+        if generated is None:
+            if report is not None: report(1, 'time_budget_exceeded', template=rxn.reaction_smarts)
+            truncated = True
+            break
+        outcome, atoms_changed, mapped_outcome, mapnums = generated
+
+        if return_outcomes:
+            outcome_handles.append(rdchiralOutcome(outcome, atoms_changed, mapnums, mapped_outcome))
+            if max_outcomes is not None and len(outcome_handles) >= max_outcomes:
+                if tracer is not None: tracer(1, 'max_outcomes_reached', max_outcomes=max_outcomes)
+                break
+            continue
+
+        if stats is not None: t0 = perf_counter()
+        smiles = Chem.MolToSmiles(outcome, True)
+        smiles_new = canonicalize_outcome_smiles(smiles)
+        if stats is not None: stats.lap('canonicalization', t0)
+        if smiles_new is None:
+            if report is not None: report(1, 'outcome_rejected', reason='canonicalization_failed',
+                template=rxn.reaction_smarts)
+            continue
+
+        final_outcomes.add(smiles_new)
+        mapped_outcomes[smiles_new] = (mapped_outcome, atoms_changed)
+
+        if max_outcomes is not None and len(final_outcomes) >= max_outcomes:
+            if tracer is not None: tracer(1, 'max_outcomes_reached', max_outcomes=max_outcomes)
+            break
+    ###############################################################################
+    if report is not None:
+        report(1, 'outcomes', outcomes=len(outcome_handles) if return_outcomes else len(final_outcomes),
+            template=rxn.reaction_smarts)
+    if return_outcomes:
+        return (outcome_handles, truncated) if return_truncated else outcome_handles
+
+    # One last fix for consolidating multiple stereospecified products...
+    if combine_enantiomers:
+        if stats is not None: t0 = perf_counter()
+        final_outcomes = combine_enantiomers_into_racemic(final_outcomes)
+        if stats is not None: stats.lap('combine_enantiomers', t0)
+    ###############################################################################
+    if return_mapped:
+        if return_truncated:
+            return list(final_outcomes), mapped_outcomes, truncated
+        return list(final_outcomes), mapped_outcomes
+    else:
+        if return_truncated:
+            return list(final_outcomes), truncated
+        return list(final_outcomes)
+
+def _generate_outcomes(rxn, reactants, outcomes, keep_mapnums=False, defer_mapped=False,
+        deadline=None, stats=None):
+    '''Check and correct raw RunReactants outcomes, one at a time
+
+    Outcomes that should not have matched are skipped, the others are merged into
+    a single molecule with tetrahedral and cis/trans stereochemistry restored.
+
+    Args:
+        rxn (rdchiralReaction): (rdkit reaction + auxilliary information)
+        reactants (rdchiralReactants): (rdkit mol + auxilliary information)
+        outcomes (iterable): Raw outcomes of RunReactants on `reactants.reactants_achiral`
+        keep_mapnums (bool): Whether to keep map numbers or not
+        defer_mapped (bool): Whether to skip generating the atom mapped SMILES when possible
+        deadline (float, optional): Time on the `time.perf_counter` clock from which
+            no more raw outcomes are processed
+        stats (rdchiralStats, optional): Accumulates time spent in each phase
+
+    Yields:
+        (rdkit.Chem.rdchem.Mol, tuple, str, list): Outcome molecule, map numbers of
+            changed atoms, atom mapped SMILES (None if deferred) and the map numbers
+            that were removed from the outcome atoms (None unless deferred). If the
+            deadline passes, None is yielded last instead
+    '''
+
+    ###############################################################################
+    # Initialize
+
+    tracer = utils.TRACER
+    # events that the stats object counts are reported to it too
+    report = tracer if stats is None else stats.tracer(tracer)
+    processed_outcome_keys = set()
     # We need to keep track of what map numbers correspond to which atoms
     # note: all reactant atoms must be mapped, so this is safe
     atoms_r = reactants.atoms_r
@@ -146,87 +361,80 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
 
     for outcome in outcomes:
 
+        if deadline is not None and perf_counter() >= deadline:
+            yield None
+            return
+        if stats is not None: t0 = perf_counter()
+
         ###############################################################################
         # Look for new atoms in products that were not in 
         # reactants (e.g., LGs for a retro reaction)
-        if PLEVEL >= (2): print('Processing {}'.format(str([Chem.MolToSmiles(x, True) for x in outcome])))
+        if tracer is not None: tracer(2, 'outcome', smiles=[Chem.MolToSmiles(x, True) for x in outcome])
         unmapped = 900
+        mapnums_old_mapnos = [] # (map num, reactant template map num or 0) of reactant atoms
         for m in outcome:
             for a in m.GetAtoms():
                 # Assign map number to outcome based on react_atom_idx
                 if a.HasProp('react_atom_idx'):
-                    a.SetAtomMapNum(reactants.idx_to_mapnum(int(a.GetProp('react_atom_idx'))))
+                    mapnum = reactants.idx_to_mapnum(int(a.GetProp('react_atom_idx')))
+                    a.SetAtomMapNum(mapnum)
+                    mapnums_old_mapnos.append((mapnum,
+                        a.GetIntProp('old_mapno') if a.HasProp('old_mapno') else 0))
                 if not a.GetAtomMapNum():
                     a.SetAtomMapNum(unmapped)
                     unmapped += 1
-        if PLEVEL >= 2: print('Added {} map numbers to product'.format(unmapped-900))
+        if tracer is not None: tracer(2, 'product_map_numbers_added', added=unmapped-900)
         ###############################################################################
 
 
         ###############################################################################
-        # Check to see if reactants should not have been matched (based on chirality)
+        # Skip outcomes that assign the same reactant atoms to the same template
+        # atoms as an outcome we already processed (e.g., symmetric matches). They
+        # would be turned into exactly the same product.
+        outcome_key = tuple(sorted(mapnums_old_mapnos))
+        if stats is not None: t0 = stats.lap('map_numbers', t0)
+        if outcome_key in processed_outcome_keys:
+            if report is not None: report(2, 'outcome_rejected', reason='duplicate_outcome',
+                template=rxn.reaction_smarts)
+            continue
+        processed_outcome_keys.add(outcome_key)
+        ###############################################################################
 
-        # Define map num -> reactant template atom map
-        atoms_rt =  {a.GetAtomMapNum(): atoms_rt_map[a.GetIntProp('old_mapno')] \
-            for m in outcome for a in m.GetAtoms() if a.HasProp('old_mapno')}
 
-        # Set map numbers of reactant template to be consistent with reactant/product molecules
-        # note: this is okay to do within the loop, because ALL atoms must be matched
-        # in the templates, so the atommapnum will get overwritten every time
-        [a.SetAtomMapNum(i) for (i, a) in atoms_rt.items()]
+        ###############################################################################
+        # Check to see if reactants should not have been matched (based on chirality)
+
+        # Define map num -> reactant template atom map, and map num -> original
+        # map number of that template atom
+        atoms_rt_old = {mapnum: old for (mapnum, old) in mapnums_old_mapnos if old}
+        atoms_rt = {i: atoms_rt_map[old] for (i, old) in atoms_rt_old.items()}
 
         # Make sure each atom matches
-        # note: this is a little weird because atom_chirality_matches takes three values,
-        #       -1 (both tetra but opposite), 0 (not a match), and +1 (both tetra and match)
-        #       and we only want to continue if they all equal -1 or all equal +1
-        prev = None
-        skip_outcome = False
-        for match in (atom_chirality_matches(atoms_rt[i], atoms_r[i]) for i in atoms_rt):
-            if match == 0: 
-                if PLEVEL >= 2: print('Chirality violated! Should not have gotten this match')
-                skip_outcome = True 
-                break
-            elif match == 2: # ambiguous case
-                continue
-            elif prev is None:
-                prev = match
-            elif match != prev:
-                if PLEVEL >= 2: print('Part of the template matched reactant chirality, part is inverted! Should not match')
-                skip_outcome = True 
-                break
-        if skip_outcome:
-            continue      
-        if PLEVEL >= 2: print('Chirality matches! Just checked with atom_chirality_matches')
+        # note: this uses chirality tabulated when the template and reactants were
+        #       initialized, so no atoms are touched for outcomes we reject
+        reason = check_template_chirality(atoms_rt_old, rxn.rt_chirality_by_mapnum,
+            reactants.chirality_by_mapnum)
+        if stats is not None: t0 = stats.lap('chirality_check', t0)
+        if reason is not None:
+            # 'chirality_violated' or 'partial_inversion'
+            if report is not None: report(2, 'outcome_rejected', reason=reason, template=rxn.reaction_smarts)
+            continue
 
         # Check bond chirality - iterate through reactant double bonds where
         # chirality is specified (or not). atoms defined by map number
-        skip_outcome = False
-        for atoms, dirs, is_implicit in reactants.atoms_across_double_bonds:
-            if all(i in atoms_rt for i in atoms):
-                # All atoms definining chirality were matched to the reactant template
-                # So, check if it is consistent with how the template is defined
-                #...but /=/ should match \=\ since they are both trans...
-                matched_atom_map_nums = tuple(atoms_rt[i].GetAtomMapNum() for i in atoms)
-
-                # Convert atoms_rt to original template's atom map numbers:
-                matched_atom_map_nums = tuple(rxn.atoms_rt_idx_to_map[atoms_rt[i].GetIdx()] for i in atoms)
-                
-                if matched_atom_map_nums not in rxn.required_rt_bond_defs:
-                    continue # this can happen in ring openings, for example
-                dirs_template = rxn.required_rt_bond_defs[matched_atom_map_nums]
-                if dirs != dirs_template and \
-                        (BondDirOpposite[dirs[0]], BondDirOpposite[dirs[1]]) != dirs_template and \
-                        not (dirs_template == (BondDir.NONE, BondDir.NONE) and is_implicit):
-                    if PLEVEL >= 5: print('Reactant bond chirality does not match template!')
-                    if PLEVEL >= 5: print('Based on map numbers...')
-                    if PLEVEL >= 5: print('  rct: {} -> {}'.format(matched_atom_map_nums, dirs))
-                    if PLEVEL >= 5: print('  tmp: {} -> {}'.format(matched_atom_map_nums, dirs_template))
-                    if PLEVEL >= 5: print('skipping this outcome, should not have matched...')
-                    skip_outcome = True 
-                    break
-        if skip_outcome:
+        bond_dirs_match = check_template_bond_dirs(atoms_rt_old,
+            reactants.atoms_across_double_bonds, rxn.required_rt_bond_defs)
+        if stats is not None: t0 = stats.lap('bond_check', t0)
+        if not bond_dirs_match:
+            if report is not None: report(2, 'outcome_rejected', reason='bond_stereo_mismatch',
+                template=rxn.reaction_smarts)
             continue
 
+        # Set map numbers of reactant template to be consistent with reactant/product molecules
+        # note: this is okay to do within the loop, because ALL atoms must be matched
+        # in the templates, so the atommapnum will get overwritten every time
+        [a.SetAtomMapNum(i) for (i, a) in atoms_rt.items()]
+
         ###############################################################################
 
 
@@ -239,7 +447,7 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
 
         mapnums = [a.GetAtomMapNum() for m in outcome for a in m.GetAtoms() if a.GetAtomMapNum()]
         if len(mapnums) != len(set(mapnums)): # duplicate?
-            if PLEVEL >= 1: print('Found duplicate mapnums in product - need to stitch')
+            if tracer is not None: tracer(1, 'product_stitch')
             # need to do a fancy merge
             merged_mol = Chem.RWMol(outcome[0])
             merged_map_to_id = {a.GetAtomMapNum(): a.GetIdx() for a in outcome[0].GetAtoms() if a.GetAtomMapNum()}
@@ -251,9 +459,8 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
                 for b in new_mol.GetBonds():
                     bi = b.GetBeginAtom().GetAtomMapNum()
                     bj = b.GetEndAtom().GetAtomMapNum()
-                    if PLEVEL >= 10: print('stitching bond between {} and {} in stich has chirality {}, {}'.format(
-                        bi, bj, b.GetStereo(), b.GetBondDir()
-                    ))
+                    if tracer is not None: tracer(10, 'product_stitch_bond', begin=bi, end=bj,
+                        stereo=b.GetStereo(), bond_dir=b.GetBondDir())
                     if not merged_mol.GetBondBetweenAtoms(
                             merged_map_to_id[bi], merged_map_to_id[bj]):
                         merged_mol.AddBond(merged_map_to_id[bi],
@@ -265,13 +472,12 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
                             merged_map_to_id[bi], merged_map_to_id[bj]
                         ).SetBondDir(b.GetBondDir())
             outcome = merged_mol.GetMol()
-            if PLEVEL >= 1: print('Merged editable mol, converted back to real mol, {}'.format(Chem.MolToSmiles(outcome, True)))
+            if tracer is not None: tracer(1, 'product_stitched', smiles=Chem.MolToSmiles(outcome, True))
         else:
             new_outcome = outcome[0]
             for j in range(1, len(outcome)):
                 new_outcome = AllChem.CombineMols(new_outcome, outcome[j])
             outcome = new_outcome
-        if PLEVEL >= 2: print('Converted all outcomes to single molecules')
         ###############################################################################
 
 
@@ -289,6 +495,7 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
         # in the templates, so the map numbers will get overwritten every time
         # This makes it easier to check parity changes
         [a.SetAtomMapNum(i) for (i, a) in atoms_pt.items()]
+        if stats is not None: t0 = stats.lap('merge', t0)
         ###############################################################################
 
 
@@ -307,7 +514,7 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
                         # the reactant template did not specify a bond between those atoms (e.g., intentionally destroy)
                         missing_bonds.append((i, j, b))
         if missing_bonds:
-            if PLEVEL >= 1: print('Product is missing non-reacted bonds that were present in reactants!')
+            if tracer is not None: tracer(1, 'missing_bonds', bonds=[(i, j) for (i, j, b) in missing_bonds])
             outcome = Chem.RWMol(outcome)
             rwmol_map_to_id = {a.GetAtomMapNum(): a.GetIdx() for a in outcome.GetAtoms() if a.GetAtomMapNum()}
             for (i, j, b) in missing_bonds:
@@ -318,8 +525,7 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
                 new_b.SetIsAromatic(b.GetIsAromatic())
             outcome = outcome.GetMol()
             atoms_p = {a.GetAtomMapNum(): a for a in outcome.GetAtoms() if a.GetAtomMapNum()}
-        else:
-            if PLEVEL >= 3: print('No missing bonds')
+        if stats is not None: t0 = stats.lap('missing_bonds', t0)
         ###############################################################################
 
 
@@ -330,12 +536,16 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
             Chem.SanitizeMol(outcome)
             outcome.UpdatePropertyCache()
         except ValueError as e: 
-            if PLEVEL >= 1: print('{}, {}'.format(Chem.MolToSmiles(outcome, True), e))
+            if stats is not None: stats.lap('sanitize', t0)
+            if report is not None: report(1, 'outcome_rejected', reason='sanitization_failed',
+                template=rxn.reaction_smarts, smiles=Chem.MolToSmiles(outcome, True), error=str(e))
             continue
+        if stats is not None: t0 = stats.lap('sanitize', t0)
 
 
         ###############################################################################
         # Correct tetra chirality in the outcome
+        skip_outcome = False
         tetra_copied_from_reactants = []
         for a in outcome.GetAtoms():
             # Participants in reaction core (from reactants) will have old_mapno
@@ -347,10 +557,12 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
                 if not a.HasProp('react_atom_idx'):
                     # Atoms only appear in product template - their chirality
                     # should be properly instantiated by RDKit...hopefully...
-                    if PLEVEL >= 4: print('Atom {} created by product template, should have right chirality'.format(a.GetAtomMapNum()))
+                    if tracer is not None: tracer(4, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                        action='keep_product_template')
                 
                 else:
-                    if PLEVEL >= 4: print('Atom {} outside of template, copy chirality from reactants'.format(a.GetAtomMapNum()))
+                    if tracer is not None: tracer(4, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                        action='copy_from_reactants')
                     copy_chirality(atoms_r[a.GetAtomMapNum()], a)
                     if a.GetChiralTag() != ChiralType.CHI_UNSPECIFIED:
                         tetra_copied_from_reactants.append(a)
@@ -359,65 +571,60 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
                 # Part of reactants and reaction core
                 
                 if template_atom_could_have_been_tetra(atoms_rt[a.GetAtomMapNum()]):
-                    if PLEVEL >= 3: print('Atom {} was in rct template (could have been tetra)'.format(a.GetAtomMapNum()))
-                    
                     if template_atom_could_have_been_tetra(atoms_pt[a.GetAtomMapNum()]):
-                        if PLEVEL >= 3: print('Atom {} in product template could have been tetra, too'.format(a.GetAtomMapNum()))
-                        
                         # Was the product template specified?
                         
                         if atoms_pt[a.GetAtomMapNum()].GetChiralTag() == ChiralType.CHI_UNSPECIFIED:
                             # No, leave unspecified in product
-                            if PLEVEL >= 3: print('...but it is not specified in product, so destroy chirality')
+                            if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                                action='destroy')
                             a.SetChiralTag(ChiralType.CHI_UNSPECIFIED)
                         
                         else:
                             # Yes
-                            if PLEVEL >= 3: print('...and product is specified')
-                            
                             # Was the reactant template specified?
                             
                             if atoms_rt[a.GetAtomMapNum()].GetChiralTag() == ChiralType.CHI_UNSPECIFIED:
                                 # No, so the reaction introduced chirality
-                                if PLEVEL >= 3: print('...but reactant template was not, so copy from product template')
+                                if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                                    action='copy_from_product_template')
                                 copy_chirality(atoms_pt[a.GetAtomMapNum()], a)
                             
                             else:
                                 # Yes, so we need to check if chirality should be preserved or inverted
-                                if PLEVEL >= 3: print('...and reactant template was, too! copy from reactants')
+                                if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                                    action='copy_from_reactants')
                                 copy_chirality(atoms_r[a.GetAtomMapNum()], a)
                                 if atom_chirality_matches(atoms_pt[a.GetAtomMapNum()], atoms_rt[a.GetAtomMapNum()]) == -1:
-                                    if PLEVEL >= 3: print('but! reactant template and product template have opposite stereochem, so invert')
+                                    if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                                        action='invert')
                                     a.InvertChirality()
                     
                     else:
                         # Reactant template chiral, product template not - the
                         # reaction is supposed to destroy chirality, so leave
                         # unspecified
-                        if PLEVEL >= 3: print('If reactant template could have been ' +
-                            'chiral, but the product template could not, then we dont need ' +
-                            'to worry about specifying product atom chirality')
+                        if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                            action='leave_unspecified')
 
                 else:
-                    if PLEVEL >= 3: print('Atom {} could not have been chiral in reactant template'.format(a.GetAtomMapNum()))
-                    
                     if not template_atom_could_have_been_tetra(atoms_pt[a.GetAtomMapNum()]):
-                        if PLEVEL >= 3: print('Atom {} also could not have been chiral in product template', a.GetAtomMapNum())
-                        if PLEVEL >= 3: print('...so, copy chirality from reactant instead')
+                        if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                            action='copy_from_reactants')
                         copy_chirality(atoms_r[a.GetAtomMapNum()], a)
                         if a.GetChiralTag() != ChiralType.CHI_UNSPECIFIED:
                             tetra_copied_from_reactants.append(a)
                     
                     else:
-                        if PLEVEL >= 3: print('Atom could/does have product template chirality!'.format(a.GetAtomMapNum()))
-                        if PLEVEL >= 3: print('...so, copy chirality from product template')
+                        if tracer is not None: tracer(3, 'tetra_correction', mapnum=a.GetAtomMapNum(),
+                            action='copy_from_product_template')
                         copy_chirality(atoms_pt[a.GetAtomMapNum()], a)
                     
-            if PLEVEL >= 3: print('New chiral tag {}'.format(a.GetChiralTag()))
+            if tracer is not None: tracer(3, 'tetra_tag', mapnum=a.GetAtomMapNum(), tag=a.GetChiralTag())
+        if stats is not None: t0 = stats.lap('tetra_correction', t0)
         if skip_outcome:
-            if PLEVEL >= 2: print('Skipping this outcome - chirality broken?')
             continue
-        if PLEVEL >= 2: print('After attempting to re-introduce chirality, outcome = {}'.format(Chem.MolToSmiles(outcome, True)))
+        if tracer is not None: tracer(2, 'tetra_corrected', smiles=Chem.MolToSmiles(outcome, True))
         ###############################################################################
 
 
@@ -438,18 +645,18 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
             if ba.GetDegree() == 1 or bb.GetDegree() == 1:
                 continue
 
-            if PLEVEL >= 5: print('Looking at outcome bond {}={}'.format(ba.GetAtomMapNum(), bb.GetAtomMapNum()))
 
             if ba.HasProp('old_mapno') and bb.HasProp('old_mapno'):
                 # Need to rely on templates for bond chirality, both atoms were
                 # in the reactant template 
-                if PLEVEL >= 5: print('Both atoms in this double bond were in the reactant template')
                 if (ba.GetIntProp('old_mapno'), bb.GetIntProp('old_mapno')) in \
                         rxn.required_bond_defs_coreatoms:   
-                    if PLEVEL >= 5: print('and reactant template *could* have specified the chirality!')
-                    if PLEVEL >= 5: print('..product should be property instantiated')
+                    # reactant template *could* have specified the chirality, so
+                    # the product should be properly instantiated
+                    if tracer is not None: tracer(5, 'bond_direction', begin=ba.GetAtomMapNum(),
+                        end=bb.GetAtomMapNum(), action='keep_product_template')
                     continue
-                if PLEVEL >= 5: print('But it was impossible to have specified chirality (e.g., aux C=C for context)')
+                # it was impossible to have specified chirality (e.g., aux C=C for context)
 
             elif not ba.HasProp('react_atom_idx') and not bb.HasProp('react_atom_idx'):
                 # The atoms were both created by the product template, so any bond
@@ -460,8 +667,8 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
             # Need to copy from reactants, this double bond was simply carried over,
             # *although* one of the atoms could have reacted and been an auxilliary
             # atom in the reaction, e.g., C/C=C(/CO)>>C/C=C(/C[Br])
-            if PLEVEL >= 5: print('Restoring cis/trans character of bond {}={} from reactants'.format(
-                ba.GetAtomMapNum(), bb.GetAtomMapNum()))
+            if tracer is not None: tracer(5, 'bond_direction', begin=ba.GetAtomMapNum(),
+                end=bb.GetAtomMapNum(), action='copy_from_reactants')
             
             # Start with setting the BeginAtom
             begin_atom_specified = restore_bond_stereo_to_sp2_atom(ba, reactants.bond_dirs_by_mapnum)
@@ -475,26 +682,34 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
             end_atom_specified = restore_bond_stereo_to_sp2_atom(bb, reactants.bond_dirs_by_mapnum)
             if not end_atom_specified:
                 # note: this can happen if C=C/C-N turns into C=C/C=N 
-                if PLEVEL >= 1:
-                    print(reactants.bond_dirs_by_mapnum)
-                    print(ba.GetAtomMapNum())
-                    print(bb.GetAtomMapNum())
-                    print(Chem.MolToSmiles(reactants.reactants, True))
-                    print(Chem.MolToSmiles(outcome, True))
-                    print('Uh oh, looks like bond direction is only specified for half of this bond?')
+                if tracer is not None: tracer(1, 'bond_direction_half_specified',
+                    begin=ba.GetAtomMapNum(), end=bb.GetAtomMapNum(),
+                    bond_dirs=reactants.bond_dirs_by_mapnum,
+                    reactants=Chem.MolToSmiles(reactants.reactants, True),
+                    outcome=Chem.MolToSmiles(outcome, True))
 
+        if stats is not None: t0 = stats.lap('bond_directions', t0)
         ###############################################################################
 
         #Keep track of the reacting atoms for later use in grouping
         atoms_diff = {x:atoms_are_different(atoms_r[x],atoms_p[x]) for x in atoms_rt}
         #make tuple of changed atoms
         atoms_changed = tuple([x for x in atoms_diff.keys() if atoms_diff[x] == True])
-        mapped_outcome = Chem.MolToSmiles(outcome, True)
+        if defer_mapped and not tetra_copied_from_reactants:
+            # mapped SMILES is only generated if the caller asks for it
+            # note: not possible when stereo is re-perceived below without map numbers
+            mapnums = None if keep_mapnums else [a.GetAtomMapNum() for a in outcome.GetAtoms()]
+            mapped_outcome = None
+        else:
+            mapnums = None
+            mapped_outcome = Chem.MolToSmiles(outcome, True)
 
         if not keep_mapnums:
             for a in outcome.GetAtoms():
                 a.SetAtomMapNum(0) 
 
+        if stats is not None: t0 = stats.lap('mapped_smiles', t0)
+
         # Now, check to see if we have destroyed chirality 
         # this occurs when chirality was not actually possible (e.g., due to
         # symmetry) but we had assigned a tetrahedral center originating
@@ -506,29 +721,15 @@ def rdchiralRun(rxn, reactants, keep_mapnums=False, combine_enantiomers=True, re
             Chem.AssignStereochemistry(outcome, cleanIt=True, force=True)
             for a in tetra_copied_from_reactants:
                 if a.GetChiralTag() == ChiralType.CHI_UNSPECIFIED:
-                    if PLEVEL >= 2: print('Auxiliary reactant atom was chiral, now is broken -> skip outcome')
+                    if report is not None: report(2, 'outcome_rejected', reason='tetra_destroyed',
+                        template=rxn.reaction_smarts, mapnum=a.GetAtomMapNum())
                     skip_outcome = True 
                     break 
+        if stats is not None: stats.lap('tetra_check', t0)
         if skip_outcome:
             continue
 
-
-        smiles = Chem.MolToSmiles(outcome, True)
-        smiles_new = canonicalize_outcome_smiles(smiles)
-        if smiles_new is None:
-            continue
-
-        final_outcomes.add(smiles_new)
-        mapped_outcomes[smiles_new] = (mapped_outcome, atoms_changed)
-    ###############################################################################
-    # One last fix for consolidating multiple stereospecified products...
-    if combine_enantiomers:
-        final_outcomes = combine_enantiomers_into_racemic(final_outcomes)
-    ###############################################################################
-    if return_mapped:
-        return list(final_outcomes), mapped_outcomes
-    else:
-        return list(final_outcomes)
+        yield outcome, atoms_changed, mapped_outcome, mapnums
 
 if __name__ == '__main__':
     # Directly use SMILES/SMARTS
@@ -546,3 +747,11 @@ if __name__ == '__main__':
     # Get list of atoms that changed as well
     outcomes, mapped_outcomes = rdchiralRun(rxn, reactants, return_mapped=True)
     print(outcomes, mapped_outcomes)
+
+    # Work with outcome molecules directly, SMILES are only generated on request
+    for outcome in rdchiralRun(rxn, reactants, return_outcomes=True):
+        print(outcome.mol.GetNumAtoms(), outcome.atoms_changed, outcome.smiles)
+
+    # Apply the same template to many molecules
+    for outcomes in rdchiralRunBatch(rxn, [reactant_smiles, 'OCCO']):
+        print(outcomes)
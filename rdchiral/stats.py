@@ -0,0 +1,214 @@
+from __future__ import print_function
+from time import perf_counter
+
+'''
+This file contains the profiling hooks for rdchiralRun.
+
+An rdchiralStats object can be passed to rdchiralRun (and rdchiralRunBatch or
+TemplateLibrary.expand) as `stats`. It accumulates wall-clock time and the
+number of calls for each phase of the run, along with counters of what
+happened to the outcomes. The counters are fed by the same events that are
+reported to the tracer (see `rdchiral.utils.set_tracer`): rdchiralRun reports
+them to the stats object, which is itself a tracer, and passes them on to the
+installed tracer if there is one. When no stats object is given, the only
+cost is a check for None at each phase boundary.
+
+The phases are, in the order they happen:
+
+    prefilter            checking raw matches for stereochemistry (single-reactant templates)
+    run_reactants        RDKit's RunReactants on the achiral reactants
+    map_numbers          assigning map numbers to outcome atoms, skipping duplicate outcomes
+    chirality_check      checking tetrahedral centers against the reactant template
+    bond_check           checking double bond stereo against the reactant template
+    merge                merging (or stitching) product fragments into one molecule
+    missing_bonds        restoring reactant bonds that were not in the template
+    sanitize             sanitizing the outcome
+    tetra_correction     copying/inverting tetrahedral chirality
+    bond_directions      restoring cis/trans bond directions from the reactants
+    mapped_smiles        changed atoms, atom-mapped SMILES and clearing map numbers
+    tetra_check          checking that copied tetrahedral centers survived
+    canonicalization     generating the canonical SMILES of each outcome
+    combine_enantiomers  combining enantiomers into racemic outcomes
+
+Counters are also kept per template (keyed by reaction SMARTS), so that the
+reasons raw outcomes were rejected can be aggregated over a template library.
+Templates whose raw outcomes are almost always discarded waste the time spent
+in RunReactants and are candidates for pruning or rewriting, see
+`rdchiralStats.rejection_summary`. The rejection reasons are
+
+    all_matches_rejected     prefilter found that every match violates stereochemistry
+    chirality_violated       tetrahedral center does not match the reactant template
+    partial_inversion        only some of the template's tetrahedral centers are inverted
+    bond_stereo_mismatch     double bond stereo does not match the reactant template
+    sanitization_failed      outcome could not be sanitized
+    tetra_destroyed          a copied tetrahedral center did not survive (e.g., symmetry)
+    canonicalization_failed  outcome SMILES could not be canonicalized
+'''
+
+PHASES = ('prefilter', 'run_reactants', 'map_numbers', 'chirality_check', 'bond_check',
+    'merge', 'missing_bonds', 'sanitize', 'tetra_correction', 'bond_directions',
+    'mapped_smiles', 'tetra_check', 'canonicalization', 'combine_enantiomers')
+
+REJECTION_REASONS = ('all_matches_rejected', 'chirality_violated', 'partial_inversion',
+    'bond_stereo_mismatch', 'sanitization_failed', 'tetra_destroyed', 'canonicalization_failed')
+
+class rdchiralStats(object):
+    '''Timers and counters for the phases of rdchiralRun
+
+    Attributes:
+        times (dict): Total seconds spent in each phase
+        calls (dict): Number of times each phase ran
+        counters (dict): Number of occurrences of events, e.g., 'runs', 'raw_outcomes',
+            'duplicate_outcome', 'outcomes', 'truncated' or one of REJECTION_REASONS
+        by_template (dict): Counters per template, keyed by reaction SMARTS
+        callback (callable): Called as callback(phase, seconds) whenever a phase
+            finishes, or None
+
+    Args:
+        callback (callable, optional): Called as callback(phase, seconds) whenever
+            a phase finishes
+    '''
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        '''Set all timers and counters back to zero'''
+        self.times = {phase: 0. for phase in PHASES}
+        self.calls = {phase: 0 for phase in PHASES}
+        self.counters = {}
+        self.by_template = {}
+
+    def lap(self, phase, start):
+        '''Record that a phase ran from `start` until now
+
+        Args:
+            phase (str): Phase name
+            start (float): Start time on the `time.perf_counter` clock
+
+        Returns:
+            float: The current time, to be used as start of the next phase
+        '''
+        now = perf_counter()
+        self.times[phase] = self.times.get(phase, 0.) + now - start
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        if self.callback is not None:
+            self.callback(phase, now - start)
+        return now
+
+    def count(self, event, n=1, template=None):
+        '''Add `n` occurrences of `event`, also to the counters of `template` if given
+
+        Args:
+            event (str): Event name, e.g., one of REJECTION_REASONS
+            n (int): Number of occurrences
+            template (str, optional): Reaction SMARTS of the template the event belongs to
+        '''
+        self.counters[event] = self.counters.get(event, 0) + n
+        if template is not None:
+            counters = self.by_template.get(template)
+            if counters is None:
+                counters = self.by_template[template] = {}
+            counters[event] = counters.get(event, 0) + n
+
+    def __call__(self, level, event, **fields):
+        '''Count a tracer event, see `rdchiral.utils.set_tracer`
+
+        Args:
+            level (int): Verbosity level of the event (ignored)
+            event (str): Event name
+            **fields: Event fields, 'template' is the reaction SMARTS of the template
+        '''
+        template = fields.get('template')
+        if event == 'outcome_rejected':
+            self.count(fields['reason'], template=template)
+        elif event == 'run_reactants':
+            self.count('runs', template=template)
+            self.count('raw_outcomes', fields['outcomes'], template=template)
+        elif event == 'outcomes':
+            self.count('outcomes', fields['outcomes'], template=template)
+        elif event == 'all_matches_rejected':
+            self.count(event, template=template)
+        elif event == 'time_budget_exceeded':
+            self.count('truncated')
+
+    def tracer(self, tracer=None):
+        '''Tracer that counts events in this object and passes them on to `tracer`
+
+        Args:
+            tracer (callable, optional): Tracer to pass the events on to
+
+        Returns:
+            callable: This object if `tracer` is None, otherwise a new tracer
+        '''
+        if tracer is None:
+            return self
+        def both(level, event, **fields):
+            self(level, event, **fields)
+            tracer(level, event, **fields)
+        return both
+
+    def merge(self, other):
+        '''Add the timers and counters of another rdchiralStats object to this one'''
+        for (phase, seconds) in other.times.items():
+            self.times[phase] = self.times.get(phase, 0.) + seconds
+        for (phase, n) in other.calls.items():
+            self.calls[phase] = self.calls.get(phase, 0) + n
+        for (event, n) in other.counters.items():
+            self.counters[event] = self.counters.get(event, 0) + n
+        for (template, counters) in other.by_template.items():
+            mine = self.by_template.setdefault(template, {})
+            for (event, n) in counters.items():
+                mine[event] = mine.get(event, 0) + n
+
+    def as_dict(self):
+        '''Plain dictionary with 'times', 'calls' and 'counters', e.g., for json.dump'''
+        return {'times': dict(self.times), 'calls': dict(self.calls),
+            'counters': dict(self.counters),
+            'by_template': {template: dict(counters) for (template, counters) in self.by_template.items()}}
+
+    def rejection_summary(self, top=None):
+        '''Templates sorted by how many of their raw outcomes were rejected
+
+        Args:
+            top (int, optional): Only return this many templates
+
+        Returns:
+            list: One dict per template with at least one rejection, with keys
+                'template', 'runs', 'raw_outcomes', 'outcomes', 'rejected' (total
+                number of rejected raw outcomes, counting a prefilter rejection
+                as one) and 'reasons' (dict of reason to count)
+        '''
+        summary = []
+        for (template, counters) in self.by_template.items():
+            reasons = {reason: counters[reason] for reason in REJECTION_REASONS if counters.get(reason)}
+            if not reasons:
+                continue
+            summary.append({
+                'template': template,
+                'runs': counters.get('runs', 0),
+                'raw_outcomes': counters.get('raw_outcomes', 0),
+                'outcomes': counters.get('outcomes', 0),
+                'rejected': sum(reasons.values()),
+                'reasons': reasons,
+            })
+        summary.sort(key=lambda entry: (-entry['rejected'], entry['outcomes'], entry['template']))
+        return summary if top is None else summary[:top]
+
+    def report(self):
+        '''Human-readable summary, phases sorted by total time
+
+        Returns:
+            str: summary table
+        '''
+        total = sum(self.times.values()) or 1.
+        lines = ['{:<20s} {:>10s} {:>6s} {:>10s}'.format('phase', 'seconds', '%', 'calls')]
+        for phase in sorted(self.times, key=lambda phase: -self.times[phase]):
+            lines.append('{:<20s} {:>10.4f} {:>6.1f} {:>10d}'.format(phase, self.times[phase],
+                100. * self.times[phase] / total, self.calls[phase]))
+        for event in sorted(self.counters):
+            lines.append('{:<20s} {:>10d}'.format(event, self.counters[event]))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return 'rdchiralStats({:.4f} s, {})'.format(sum(self.times.values()), self.counters)
@@ -1,6 +1,5 @@
 import re
-from numpy.random import shuffle
-from copy import deepcopy
+from collections import Counter
 from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit.Chem.rdchem import ChiralType
@@ -72,21 +71,28 @@ def find_map_num(mol, mapnum):
          and a.GetProp('molAtomMapNumber') == str(mapnum)][0]
 
 def get_tetrahedral_atoms(reactants, products):
+    # First atom with each map number, for each product
+    product_atoms_by_tag = []
+    for product in products:
+        atoms_by_tag = {}
+        for ap in product.GetAtoms():
+            if ap.HasProp('molAtomMapNumber'):
+                atoms_by_tag.setdefault(ap.GetProp('molAtomMapNumber'), ap)
+        product_atoms_by_tag.append(atoms_by_tag)
+
     tetrahedral_atoms = []
     for reactant in reactants:
         for ar in reactant.GetAtoms():
             if not ar.HasProp('molAtomMapNumber'):
                 continue
             atom_tag = ar.GetProp('molAtomMapNumber')
-            ir = ar.GetIdx()
-            for product in products:
-                try:
-                    (ip, ap) = find_map_num(product, atom_tag)
-                    if ar.GetChiralTag() != ChiralType.CHI_UNSPECIFIED or\
-                            ap.GetChiralTag() != ChiralType.CHI_UNSPECIFIED:
-                        tetrahedral_atoms.append((atom_tag, ar, ap))
-                except IndexError:
-                    pass
+            for atoms_by_tag in product_atoms_by_tag:
+                ap = atoms_by_tag.get(atom_tag)
+                if ap is None:
+                    continue
+                if ar.GetChiralTag() != ChiralType.CHI_UNSPECIFIED or\
+                        ap.GetChiralTag() != ChiralType.CHI_UNSPECIFIED:
+                    tetrahedral_atoms.append((atom_tag, ar, ap))
     return tetrahedral_atoms
 
 def set_isotope_to_equal_mapnum(mol):
@@ -117,6 +123,119 @@ def check_tetrahedral_centers_equivalent(atom1, atom2):
             return True
     return False
 
+def get_fragment_atom_output_order(mol):
+    '''Parent atom idx of each atom of the SMILES fragment most recently written
+    for mol, i.e., of each atom of that fragment after parsing it again'''
+    return [int(i) for i in mol.GetProp('_smilesAtomOutputOrder').strip('[],').split(',')]
+
+def get_permutation_parity(order, reference):
+    '''Parity (0 for even, 1 for odd) of the permutation between two orderings
+    of the same items'''
+    order = list(order)
+    position = {item: i for (i, item) in enumerate(order)}
+    swaps = 0
+    for i, item in enumerate(reference):
+        j = position[item]
+        if j != i:
+            other = order[i]
+            order[i], order[j] = item, other
+            position[item], position[other] = i, j
+            swaps += 1
+    return swaps % 2
+
+def fragment_tetra_matches_parent(frag_atom, parent_atom, frag_to_parent):
+    '''Checks whether a tetrahedral center parsed from a fragment has the same
+    chirality as the parent atom it was written from. Neighbors that are not in
+    the fragment are put last, as substructure matching does
+
+    Args:
+        frag_atom: Atom of the (re-parsed) fragment
+        parent_atom: Atom of the parent molecule
+        frag_to_parent (list): Parent atom idx of each fragment atom idx
+
+    Returns:
+        bool: Whether the centers are equivalent
+    '''
+    parent_idx = parent_atom.GetIdx()
+    parent_neighbors = [b.GetOtherAtomIdx(parent_idx) for b in parent_atom.GetBonds()]
+    frag_neighbors = [frag_to_parent[b.GetOtherAtomIdx(frag_atom.GetIdx())]
+        for b in frag_atom.GetBonds()]
+    frag_neighbors += [i for i in parent_neighbors if i not in frag_neighbors]
+    same_tag = frag_atom.GetChiralTag() == parent_atom.GetChiralTag()
+    return same_tag != bool(get_permutation_parity(frag_neighbors, parent_neighbors))
+
+def tetra_centers_agree(atom1, atom2):
+    '''Checks whether two tetrahedral centers from different molecules have the
+    same chirality, identifying their neighbors by map number. One neighbor on
+    each side may differ (e.g., a leaving group replaced by a new substituent)
+
+    Returns:
+        bool: Whether the centers are equivalent, or None if they cannot be compared
+    '''
+    if ChiralType.CHI_UNSPECIFIED in (atom1.GetChiralTag(), atom2.GetChiralTag()):
+        return None
+    neighbors1 = [a.GetAtomMapNum() for a in atom1.GetNeighbors()]
+    neighbors2 = [a.GetAtomMapNum() for a in atom2.GetNeighbors()]
+    if len(neighbors1) < 3 or len(neighbors2) < 3:
+        return None
+    neighbors1 += [-1] * (4 - len(neighbors1)) # H
+    neighbors2 += [-1] * (4 - len(neighbors2))
+    if len(set(neighbors1)) < 4 or len(set(neighbors2)) < 4:
+        return None
+    only_in_1 = [i for i in neighbors1 if i not in neighbors2]
+    only_in_2 = [i for i in neighbors2 if i not in neighbors1]
+    if len(only_in_1) != len(only_in_2) or len(only_in_1) > 1:
+        return None
+    neighbors2 = [only_in_1[0] if i in only_in_2 else i for i in neighbors2]
+    same_tag = atom1.GetChiralTag() == atom2.GetChiralTag()
+    return same_tag != bool(get_permutation_parity(neighbors2, neighbors1))
+
+def get_ring_systems(mol):
+    '''Atom indices of each ring system (rings fused by shared bonds or atoms)'''
+    systems = []
+    for ring in mol.GetRingInfo().AtomRings():
+        ring = set(ring)
+        for system in [system for system in systems if system & ring]:
+            systems.remove(system)
+            ring |= system
+        systems.append(ring)
+    return systems
+
+def align_ring_stereo_with_products(reactants, products):
+    '''Inverts the tetrahedral ring centers of a reactant ring system together
+    when each of them is inverted relative to its mapped product atom, but the
+    molecule stays the same (e.g., the two centers of a 1,4-disubstituted
+    cyclohexane, which only have a relative configuration).
+
+    SMILES writers may invert such pairs at will, which keeps the molecule but
+    looks like an inversion of each center when atoms are compared by map
+    number. A template containing only one of the centers would then invert it.
+    '''
+    product_atoms = {}
+    for product in products:
+        for atom in product.GetAtoms():
+            if atom.GetAtomMapNum():
+                product_atoms.setdefault(atom.GetAtomMapNum(), atom)
+
+    for reactant in reactants:
+        reactant_smiles = None
+        for system in get_ring_systems(reactant):
+            centers = [reactant.GetAtomWithIdx(i) for i in sorted(system)
+                if reactant.GetAtomWithIdx(i).GetChiralTag() != ChiralType.CHI_UNSPECIFIED]
+            if not centers or any(a.GetAtomMapNum() not in product_atoms or
+                    tetra_centers_agree(a, product_atoms[a.GetAtomMapNum()]) is not False
+                    for a in centers):
+                continue
+            if reactant_smiles is None:
+                reactant_smiles = Chem.MolToSmiles(clear_mapnum(Chem.Mol(reactant)), True)
+            [a.InvertChirality() for a in centers]
+            if Chem.MolToSmiles(clear_mapnum(Chem.Mol(reactant)), True) != reactant_smiles:
+                # not a symmetry of the molecule, keep the centers as they were
+                [a.InvertChirality() for a in centers]
+            elif VERBOSE:
+                print('Inverted ring centers {} to match products'.format(
+                    [a.GetAtomMapNum() for a in centers]))
+
 def clear_isotope(mol):
     [a.SetIsotope(0) for a in mol.GetAtoms()]
 
@@ -137,33 +256,38 @@ def get_changed_atoms(reactants, products):
         if VERBOSE: print('warning: total number of tagged atoms differ, stoichometry != 1?')
         #err = 1
 
+    # Index atoms by map number
+    reac_idx_by_tag = {}
+    for j, reac_tag in enumerate(reac_atom_tags):
+        reac_idx_by_tag.setdefault(reac_tag, []).append(j)
+    prod_tag_counts = Counter(prod_atom_tags)
+
     # Find differences 
     changed_atoms = [] # actual reactant atom species
     changed_atom_tags = [] # atom map numbers of those atoms
+    changed_atom_tag_set = set() # same, for lookups
 
     # Product atoms that are different from reactant atom equivalent
     for i, prod_tag in enumerate(prod_atom_tags):
+        if prod_tag in changed_atom_tag_set: # don't bother comparing if we know this atom changes
+            continue
 
-        for j, reac_tag in enumerate(reac_atom_tags):
-            if reac_tag != prod_tag: continue
-            if reac_tag not in changed_atom_tags: # don't bother comparing if we know this atom changes
-                # If atom changed, add
-                if atoms_are_different(prod_atoms[i], reac_atoms[j]):
-                    changed_atoms.append(reac_atoms[j])
-                    changed_atom_tags.append(reac_tag)
-                    break
-                # If reac_tag appears multiple times, add (need for stoichometry > 1)
-                if prod_atom_tags.count(reac_tag) > 1:
-                    changed_atoms.append(reac_atoms[j])
-                    changed_atom_tags.append(reac_tag)
-                    break
+        for j in reac_idx_by_tag.get(prod_tag, ()):
+            # If reac_tag appears multiple times, add (need for stoichometry > 1)
+            # If atom changed, add
+            if prod_tag_counts[prod_tag] > 1 or atoms_are_different(prod_atoms[i], reac_atoms[j]):
+                changed_atoms.append(reac_atoms[j])
+                changed_atom_tags.append(prod_tag)
+                changed_atom_tag_set.add(prod_tag)
+                break
 
     # Reactant atoms that do not appear in product (tagged leaving groups)
     for j, reac_tag in enumerate(reac_atom_tags):
-        if reac_tag not in changed_atom_tags:
-            if reac_tag not in prod_atom_tags:
+        if reac_tag not in changed_atom_tag_set:
+            if reac_tag not in prod_tag_counts:
                 changed_atoms.append(reac_atoms[j])
                 changed_atom_tags.append(reac_tag)
+                changed_atom_tag_set.add(reac_tag)
 
     # Atoms that change CHIRALITY (just tetrahedral for now...)
     tetra_atoms = get_tetrahedral_atoms(reactants, products)
@@ -176,7 +300,7 @@ def get_changed_atoms(reactants, products):
             print('For atom tag {}'.format(atom_tag))
             print('    reactant: {}'.format(ar.GetChiralTag()))
             print('    product:  {}'.format(ap.GetChiralTag()))
-        if atom_tag in changed_atom_tags:
+        if atom_tag in changed_atom_tag_set:
             if VERBOSE:
                 print('-> atoms have changed (by more than just chirality!)')
         else:
@@ -193,13 +317,14 @@ def get_changed_atoms(reactants, products):
                 tetra_adj_to_rxn = False
                 for neighbor in ap.GetNeighbors():
                     if neighbor.HasProp('molAtomMapNumber'):
-                        if neighbor.GetProp('molAtomMapNumber') in changed_atom_tags:
+                        if neighbor.GetProp('molAtomMapNumber') in changed_atom_tag_set:
                             tetra_adj_to_rxn = True
                             break
                 if tetra_adj_to_rxn:
                     if VERBOSE:
                         print('-> atom adj to reaction center, now included')
                     changed_atom_tags.append(atom_tag)
+                    changed_atom_tag_set.add(atom_tag)
                     changed_atoms.append(ar)
                 else:
                     if VERBOSE:
@@ -215,18 +340,78 @@ def get_changed_atoms(reactants, products):
 
     return changed_atoms, changed_atom_tags, err
 
-def get_special_groups(mol):
-    '''Given an RDKit molecule, this function returns a list of tuples, where
-    each tuple contains the AtomIdx's for a special group of atoms which should 
-    be included in a fragment all together. This should only be done for the 
-    reactants, otherwise the products might end up with mapping mismatches
+# Special groups of atoms which should be included in a fragment all together,
+# as (pattern atom indices whose match triggers the group, SMARTS, query molecule,
+# elements required to match). Built once, see `register_special_group`
+SPECIAL_GROUPS = []
 
-    We draw a distinction between atoms in groups that trigger that whole
-    group to be included, and "unimportant" atoms in the groups that will not
-    be included if another atom matches.'''
+_periodic_table = Chem.GetPeriodicTable()
+# Element symbols as they can appear in a SMARTS primitive, aromatic ones in lowercase
+_atomic_numbers = {_periodic_table.GetElementSymbol(z): z for z in range(1, 119)}
+_atomic_numbers.update({symbol: _atomic_numbers[symbol.capitalize()]
+    for symbol in ('b', 'c', 'n', 'o', 'p', 's', 'se', 'as', 'te')})
+
+def _element_of_primitive(primitive):
+    '''Atomic number required by a single SMARTS primitive, or None
+
+    Only '#<number>' and element symbols (capitalized, or lowercase aromatic
+    ones) count, so that, e.g., 'h' (implicit hydrogens) and 'v' (valence) are
+    not read as elements. 'H', 'D', 'R', 'X' and 'A' are atom properties here.
+    '''
+    if primitive.startswith('#') and primitive[1:].isdigit():
+        return int(primitive[1:])
+    if primitive in ('H', 'D', 'R', 'X', 'A'):
+        return None
+    return _atomic_numbers.get(primitive)
+
+def _elements_of_query_atom(atom):
+    '''Set of atomic numbers a SMARTS query atom can match, or None if unknown
 
-    # Define templates
-    group_templates = [ 
+    Only needs to be conservative: None is always a safe answer, and the set
+    is never empty.
+    '''
+    smarts = atom.GetSmarts()
+    if smarts.startswith('['):
+        smarts = smarts[1:-1]
+    if '$' in smarts or '!' in smarts:
+        # recursive SMARTS and negations are not worth analyzing
+        return None
+    elements = None
+    for part in smarts.split(';'): # low-precedence and
+        part_elements = set()
+        for alternative in part.split(','): # or
+            alternative_elements = set(_element_of_primitive(primitive)
+                for primitive in alternative.split('&')) # high-precedence and
+            alternative_elements.discard(None)
+            if len(alternative_elements) != 1:
+                # any element, or one we do not understand
+                part_elements = None
+                break
+            part_elements |= alternative_elements
+        if part_elements is not None:
+            elements = part_elements if elements is None else elements & part_elements
+    return elements or None
+
+def register_special_group(smarts, add_if_match):
+    '''Add a special group to those found by `get_special_groups`
+
+    Args:
+        smarts (str): SMARTS pattern of the group
+        add_if_match (iterable): Pattern atom indices that, when matched to a changed
+            atom, cause the whole group to be included
+    '''
+    query = Chem.MolFromSmarts(smarts)
+    if query is None:
+        raise ValueError('Could not parse special group SMARTS {}'.format(smarts))
+    required_elements = []
+    for atom in query.GetAtoms():
+        elements = _elements_of_query_atom(atom)
+        if elements is not None and frozenset(elements) not in required_elements:
+            required_elements.append(frozenset(elements))
+    SPECIAL_GROUPS.append((tuple(add_if_match), smarts, query, tuple(required_elements)))
+
+# Define templates
+for (add_if_match, smarts) in [
         (range(3), '[OH0,SH0]=C[O,Cl,I,Br,F]',), # carboxylic acid / halogen
         (range(3), '[OH0,SH0]=CN',), # amide/sulfamide
         (range(4), 'S(O)(O)[Cl]',), # sulfonyl chloride
@@ -254,21 +439,37 @@ def get_special_groups(mol):
         #((1,), 'c(-,=[*]):c([Cl,I,Br,F])',), # ortho to halogen on ring - too specific?
         #((1,), 'c(-,=[*]):c:c([Cl,I,Br,F])',), # meta to halogen on ring - too specific?
         ((0,), '[B,C](F)(F)F'), # CF3, BF3 should have the F3 included
-    ]
 
-    # Stereo-specific ones (where we will need to include neighbors)
-    # Tetrahedral centers should already be okay...
-    group_templates += [
+        # Stereo-specific ones (where we will need to include neighbors)
+        # Tetrahedral centers should already be okay...
         ((1,2,), '[*]/[CH]=[CH]/[*]'), # trans with two hydrogens
-        ((1,2,), '[*]/[CH]=[CH]\[*]'), # cis with two hydrogens
-        ((1,2,), '[*]/[CH]=[CH0]([*])\[*]'), # trans with one hydrogens
+        ((1,2,), '[*]/[CH]=[CH]\\[*]'), # cis with two hydrogens
+        ((1,2,), '[*]/[CH]=[CH0]([*])\\[*]'), # trans with one hydrogens
         ((1,2,), '[*]/[D3;H1]=[!D1]'), # specified on one end, can be N or C
-    ]
+        ]:
+    register_special_group(smarts, add_if_match)
+
+def get_special_groups(mol):
+    '''Given an RDKit molecule, this function returns a list of tuples, where
+    each tuple contains the AtomIdx's for a special group of atoms which should 
+    be included in a fragment all together. This should only be done for the 
+    reactants, otherwise the products might end up with mapping mismatches
+
+    We draw a distinction between atoms in groups that trigger that whole
+    group to be included, and "unimportant" atoms in the groups that will not
+    be included if another atom matches.
+
+    The groups are those in SPECIAL_GROUPS. Groups that need an element the
+    molecule does not contain are skipped without a substructure search.'''
+
+    elements = set(a.GetAtomicNum() for a in mol.GetAtoms())
 
     # Build list
     groups = []
-    for (add_if_match, template) in group_templates:
-        matches = mol.GetSubstructMatches(Chem.MolFromSmarts(template), useChirality=True)
+    for (add_if_match, smarts, query, required_elements) in SPECIAL_GROUPS:
+        if any(elements.isdisjoint(required) for required in required_elements):
+            continue
+        matches = mol.GetSubstructMatches(query, useChirality=True)
         for match in matches:
             add_if = []
             for pattern_idx, atom_idx in enumerate(match):
@@ -566,70 +767,42 @@ def get_fragments_for_changed_atoms(mols, changed_atom_tags, radius=0,
         if not atoms_to_use: 
             continue
         
-        # Keep flipping stereocenters until we are happy...
-        # this is a sloppy fix during extraction to achieve consistency
-        tetra_consistent = False
-        num_tetra_flips = 0
-        while not tetra_consistent and num_tetra_flips < 100:
-            mol_copy = deepcopy(mol)
-            [x.ClearProp('molAtomMapNumber') for x in mol_copy.GetAtoms()]   
-            this_fragment = AllChem.MolFragmentToSmiles(mol_copy, atoms_to_use, 
-                atomSymbols=symbols, allHsExplicit=True, 
-                isomericSmiles=USE_STEREOCHEMISTRY, allBondsExplicit=True)
-
-            # Figure out what atom maps are tetrahedral centers
-            # Set isotopes to make sure we're getting the *exact* match we want
-            this_fragment_mol = AllChem.MolFromSmarts(this_fragment)
-            tetra_map_nums = []
+        # Make the tetrahedral centers in the fragment consistent with the parent.
+        # note: MolFragmentToSmiles writes atomSymbols verbatim, so a chirality symbol
+        #       taken from the parent is wrong whenever the fragment lists the
+        #       neighbors of that atom in an odd permutation of the parent's order
+        mol_copy = Chem.Mol(mol)
+        [x.ClearProp('molAtomMapNumber') for x in mol_copy.GetAtoms()]
+        this_fragment = AllChem.MolFragmentToSmiles(mol_copy, atoms_to_use, 
+            atomSymbols=symbols, allHsExplicit=True, 
+            isomericSmiles=USE_STEREOCHEMISTRY, allBondsExplicit=True)
+        this_fragment_mol = AllChem.MolFromSmarts(this_fragment)
+        if this_fragment_mol is not None:
+            frag_to_parent = get_fragment_atom_output_order(mol_copy)
+            tetra_flips = []
             for atom in this_fragment_mol.GetAtoms():
-                if atom.HasProp('molAtomMapNumber'):
-                    atom.SetIsotope(int(atom.GetProp('molAtomMapNumber')))
-                    if atom.GetChiralTag() != Chem.rdchem.ChiralType.CHI_UNSPECIFIED:
-                        tetra_map_nums.append(atom.GetProp('molAtomMapNumber'))
-            map_to_id = {}
-            for atom in mol.GetAtoms():
-                if atom.HasProp('molAtomMapNumber'):
-                    atom.SetIsotope(int(atom.GetProp('molAtomMapNumber')))
-                    map_to_id[atom.GetProp('molAtomMapNumber')] = atom.GetIdx()
-            
-            # Look for matches
-            tetra_consistent = True
-            all_matched_ids = []
-            
-            # skip substructure matching if there are a lot of fragments
-            # this can help prevent GetSubstructMatches from hanging 
-            frag_smi = Chem.MolToSmiles(this_fragment_mol)
-            if frag_smi.count('.') > 5:
-                break
-            
-            for matched_ids in mol.GetSubstructMatches(this_fragment_mol, useChirality=True):
-                all_matched_ids.extend(matched_ids)
-            shuffle(tetra_map_nums)
-            for tetra_map_num in tetra_map_nums:
-                if VERBOSE: print('Checking consistency of tetrahedral {}'.format(tetra_map_num))
-                #print('Using fragment {}'.format(Chem.MolToSmarts(this_fragment_mol, True)))
-                if map_to_id[tetra_map_num] not in all_matched_ids:
-                    tetra_consistent = False
-                    if VERBOSE: print('@@@@@@@@@@@ FRAGMENT DOES NOT MATCH PARENT MOL @@@@@@@@@@@@@@')
-                    if VERBOSE: print('@@@@@@@@@@@ FLIPPING CHIRALITY SYMBOL NOW      @@@@@@@@@@@@@@')
-                    prevsymbol = symbols[map_to_id[tetra_map_num]]
-                    if '@@' in prevsymbol:
-                        symbol = prevsymbol.replace('@@', '@')
-                    elif '@' in prevsymbol:
-                        symbol = prevsymbol.replace('@', '@@')
-                    else:
-                        raise ValueError('Need to modify symbol of tetra atom without @ or @@??')
-                    symbols[map_to_id[tetra_map_num]] = symbol
-                    num_tetra_flips += 1
-                    # IMPORTANT: only flip one at a time
-                    break 
-
-            # Clear isotopes
-            for atom in mol.GetAtoms():
-                atom.SetIsotope(0)
-        
-        if not tetra_consistent:
-            raise ValueError('Could not find consistent tetrahedral mapping, {} centers'.format(len(tetra_map_nums)))
+                if not atom.HasProp('molAtomMapNumber') or \
+                        atom.GetChiralTag() == Chem.rdchem.ChiralType.CHI_UNSPECIFIED:
+                    continue
+                parent_atom = mol.GetAtomWithIdx(frag_to_parent[atom.GetIdx()])
+                if not fragment_tetra_matches_parent(atom, parent_atom, frag_to_parent):
+                    if VERBOSE: print('Flipping chirality symbol of tetrahedral {}'.format(
+                        atom.GetProp('molAtomMapNumber')))
+                    tetra_flips.append(parent_atom.GetIdx())
+
+            for idx in tetra_flips:
+                prevsymbol = symbols[idx]
+                if '@@' in prevsymbol:
+                    symbol = prevsymbol.replace('@@', '@')
+                elif '@' in prevsymbol:
+                    symbol = prevsymbol.replace('@', '@@')
+                else:
+                    raise ValueError('Need to modify symbol of tetra atom without @ or @@??')
+                symbols[idx] = symbol
+            if tetra_flips:
+                this_fragment = AllChem.MolFragmentToSmiles(mol_copy, atoms_to_use, 
+                    atomSymbols=symbols, allHsExplicit=True, 
+                    isomericSmiles=USE_STEREOCHEMISTRY, allBondsExplicit=True)
 
         fragments += '(' + this_fragment + ').'
         mols_changed.append(Chem.MolToSmiles(clear_mapnum(Chem.MolFromSmiles(Chem.MolToSmiles(mol, True))), True))
@@ -695,6 +868,22 @@ def bond_to_label(bond):
     return '{}{}{}'.format(atoms[0], bond.GetSmarts(), atoms[1])
 
 def extract_from_reaction(reaction):
+    '''Extracts the retro template of one atom-mapped reaction
+
+    The result depends only on `reaction`: there is no randomness and no
+    iteration over hash-ordered containers, so the same reaction always gives
+    the same template SMARTS, in any process and with any PYTHONHASHSEED.
+    Templates can therefore be cached, memoized and deduplicated by string.
+
+    Args:
+        reaction (dict): Reaction with '_id', 'reactants' and 'products' SMILES
+
+    Returns:
+        dict: Template with keys 'reaction_smarts', 'reactants', 'products',
+            'intra_only', 'dimer_only', 'necessary_reagent' and 'reaction_id',
+            just {'reaction_id': ...} if the reaction could not be processed,
+            or None if it was skipped
+    '''
     reactants = mols_from_smiles_list(replace_deuterated(reaction['reactants']).split('.'))
     products = mols_from_smiles_list(replace_deuterated(reaction['products']).split('.'))
     
@@ -759,6 +948,9 @@ def extract_from_reaction(reaction):
         print('ID: {}'.format(reaction['_id']))
         return {'reaction_id': reaction['_id']}
 
+    # Undo inversions of ring centers that only have a relative configuration
+    align_ring_stereo_with_products(reactants, products)
+
     # Calculate changed atoms
     changed_atoms, changed_atom_tags, err = get_changed_atoms(reactants, products)
     if err: 
@@ -0,0 +1,149 @@
+import mmap
+import struct
+
+from rdchiral.initialization import rdchiralReaction
+
+'''
+This file contains the on-disk cache format for initialized templates.
+
+A cache file stores many rdchiralReaction objects serialized with
+`rdchiralReaction.to_bytes`, so a template library can be loaded without
+re-initializing every template from its reaction SMARTS. The layout is
+
+    header   magic (8 bytes), format version (uint16), number of templates (uint64)
+    offsets  number of templates + 1 offsets (uint64), relative to the data section
+    data     serialized templates, back to back
+
+so that a single template can be located without reading the others.
+
+TemplateStore memory-maps a cache file read-only. All processes on a machine
+that open the same file share one physical copy of it through the page cache,
+and each process only deserializes the templates it actually uses.
+'''
+
+CACHE_MAGIC = b'RDCHTPL\x00'
+CACHE_VERSION = 1
+_cache_header = struct.Struct('<8sHQ')
+_cache_offset = struct.Struct('<Q')
+
+def write_template_cache(path, reactions):
+    '''Write initialized reactions to a template cache file
+
+    Args:
+        path (str): Output file path
+        reactions (iterable): rdchiralReaction objects
+
+    Returns:
+        int: Number of templates written
+    '''
+    blobs = [rxn.to_bytes() for rxn in reactions]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    with open(path, 'wb') as fid:
+        fid.write(_cache_header.pack(CACHE_MAGIC, CACHE_VERSION, len(blobs)))
+        fid.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        for blob in blobs:
+            fid.write(blob)
+    return len(blobs)
+
+def read_cache_offsets(buffer):
+    '''Parse the header and offset table of a template cache
+
+    Args:
+        buffer: bytes-like object holding the cache file contents
+
+    Returns:
+        (int, tuple): Start of the data section and the offsets of all templates
+    '''
+    magic, version, count = _cache_header.unpack_from(buffer)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        raise ValueError('Not an rdchiral template cache (version {})'.format(CACHE_VERSION))
+    offsets = struct.unpack_from('<{}Q'.format(count + 1), buffer, _cache_header.size)
+    return _cache_header.size + (count + 1) * _cache_offset.size, offsets
+
+def read_template_cache(path):
+    '''Load all reactions from a template cache file written by `write_template_cache`
+
+    Args:
+        path (str): Cache file path
+
+    Returns:
+        list: rdchiralReaction objects, in the order they were written
+    '''
+    with open(path, 'rb') as fid:
+        buffer = fid.read()
+    data_start, offsets = read_cache_offsets(buffer)
+    view = memoryview(buffer)
+    return [rdchiralReaction.from_bytes(view[data_start + offsets[i]:data_start + offsets[i + 1]])
+        for i in range(len(offsets) - 1)]
+
+class TemplateStore(object):
+    '''Read-only, memory-mapped view of a template cache file
+
+    Templates are deserialized on first access and kept afterwards, so the
+    store can be used wherever a list of rdchiralReaction objects is expected.
+
+    Attributes:
+        path (str): Cache file path
+
+    Args:
+        path (str): Cache file written by `write_template_cache`
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fid:
+            self._mmap = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data_start, self._offsets = read_cache_offsets(self._mmap)
+        self._reactions = {}
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i not in self._reactions:
+            self._reactions[i] = self.load(i)
+        return self._reactions[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _blob(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError('template index out of range')
+        return self._mmap[self._data_start + self._offsets[i]:self._data_start + self._offsets[i + 1]]
+
+    def load(self, i):
+        '''Deserialize template i without keeping it in the store
+
+        Args:
+            i (int): Template index
+
+        Returns:
+            rdchiralReaction: a new reaction object, or the one already loaded
+        '''
+        if i in self._reactions:
+            return self._reactions[i]
+        return rdchiralReaction.from_bytes(self._blob(i))
+
+    def reaction_smarts(self, i):
+        '''Reaction SMARTS of template i, without deserializing the template
+
+        Args:
+            i (int): Template index
+
+        Returns:
+            str: reaction SMARTS
+        '''
+        return rdchiralReaction.smarts_from_bytes(self._blob(i))
+
+    def close(self):
+        '''Close the memory map, templates that were already loaded stay usable'''
+        self._mmap.close()
@@ -1,10 +1,57 @@
 from __future__ import print_function
+import sys
 
 PLEVEL = 0
 def vprint(level, txt, *args):
     if PLEVEL >= level:
         print(txt.format(*args))
 
+'''
+Structured tracing. rdchiral reports what it is doing as events, e.g.,
+
+    tracer(2, 'outcome_rejected', reason='chirality_violated')
+
+where the first argument is the verbosity level of the event (the PLEVEL at
+which it used to be printed), the second the event name and the keyword
+arguments the event's fields. No tracer is installed by default, and every
+call site is guarded by `if tracer is not None`, so tracing costs nothing
+when it is disabled. Install a tracer with `set_tracer`, e.g., to collect
+rejection statistics in production or `PrintTracer(level)` for debugging.
+
+Setting PLEVEL above still works: it installs a PrintTracer of that level.
+'''
+
+class PrintTracer(object):
+    '''Tracer that prints events up to a verbosity level
+
+    Args:
+        level (int): Print events of this level and below
+        file (file, optional): Where to print to, defaults to stdout
+    '''
+    def __init__(self, level=1, file=None):
+        self.level = level
+        self.file = file
+
+    def __call__(self, level, event, **fields):
+        if level <= self.level:
+            print(event, ' '.join('{}={}'.format(k, v) for (k, v) in fields.items()),
+                file=self.file or sys.stdout)
+
+TRACER = PrintTracer(PLEVEL) if PLEVEL else None
+
+def set_tracer(tracer):
+    '''Install a tracer, called as tracer(level, event, **fields) for every event
+
+    Args:
+        tracer (callable): New tracer, or None to disable tracing
+
+    Returns:
+        callable: Previously installed tracer
+    '''
+    global TRACER
+    previous, TRACER = TRACER, tracer
+    return previous
+
 def parity4(data):
     '''
     Thanks to http://www.dalkescientific.com/writings/diary/archive/2016/08/15/fragment_parity_calculation.html
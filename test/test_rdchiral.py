@@ -1,12 +1,25 @@
-import os, sys, json
+import os, sys, json, tempfile
 sys.path = [os.path.dirname(os.path.dirname((__file__)))] + sys.path 
 
-from rdchiral.main import rdchiralReaction, rdchiralReactants, rdchiralRunText, rdchiralRun
+import rdkit.Chem as Chem
+
+from rdchiral.main import rdchiralReaction, rdchiralReactants, rdchiralRunText, rdchiralRun, \
+    rdchiralRunBatch
+from rdchiral.initialization import rdchiralReactantsCache
+from rdchiral.library import TemplateLibrary
+from rdchiral.template_store import TemplateStore, write_template_cache
+from rdchiral.template_extractor import extract_from_reaction, register_special_group, \
+    get_special_groups, SPECIAL_GROUPS
+from rdchiral.extraction import extract_templates
+from rdchiral.stats import rdchiralStats
+from rdchiral import utils
 
 with open(os.path.join(os.path.dirname(__file__), 'test_rdchiral_cases.json'), 'r') as fid:
     test_cases = json.load(fid)
 
 all_passed = True
+library = TemplateLibrary([test_case['smarts'] for test_case in test_cases])
+reactants_cache = rdchiralReactantsCache(maxsize=4)
 for i, test_case in enumerate(test_cases):
 
     print('\n# Test {:2d}/{}'.format(i+1, len(test_cases)))
@@ -29,5 +42,271 @@ for i, test_case in enumerate(test_cases):
         print('    from init: failed')
         all_passed = False
 
+    # Batch application over repeated reactants
+    if all(outcomes == test_case['expected'] for outcomes in rdchiralRunBatch(rxn, [reactants]*3)):
+        print('    from batch: passed')
+    else:
+        print('    from batch: failed')
+        all_passed = False
+
+    # Round trip through the binary template format
+    if rdchiralRun(rdchiralReaction.from_bytes(rxn.to_bytes()), reactants) == test_case['expected']:
+        print('    from bytes: passed')
+    else:
+        print('    from bytes: failed')
+        all_passed = False
+
+    # Outcome handles, same products before combining enantiomers
+    outcomes = set(outcome.smiles for outcome in rdchiralRun(rxn, reactants, return_outcomes=True))
+    if outcomes == set(rdchiralRun(rxn, reactants, combine_enantiomers=False)):
+        print('    from handles: passed')
+    else:
+        print('    from handles: failed')
+        all_passed = False
+
+    # Template library, outcomes reported for this test case's template
+    expanded = {result['template_id']: result['outcomes'] for result in library.expand(reactants)}
+    if expanded.get(i, []) == test_case['expected']:
+        print('    from library: passed')
+    else:
+        print('    from library: failed')
+        all_passed = False
+
+    # Capped runs return at most the requested number of outcomes
+    n_expected = min(1, len(test_case['expected']))
+    capped = {result['template_id']: result['outcomes']
+        for result in library.expand(reactants, max_outcomes=1)}
+    if len(rdchiralRun(rxn, reactants, max_outcomes=1)) == n_expected and \
+            len(rdchiralRun(rxn, reactants, max_products=1, combine_enantiomers=False)) <= 1 and \
+            all(len(outcomes) == 1 for outcomes in capped.values()) and \
+            len(capped.get(i, [])) == n_expected:
+        print('    with caps: passed')
+    else:
+        print('    with caps: failed')
+        all_passed = False
+
+    # Time budgets, nothing fits in zero time and a large budget changes nothing
+    results, truncated = library.expand(reactants, time_budget_ms=1e6)
+    if rdchiralRun(rxn, reactants, time_budget_ms=0) == ([], True) and \
+            rdchiralRun(rxn, reactants, time_budget_ms=1e6) == (test_case['expected'], False) and \
+            library.expand(reactants, time_budget_ms=0) == ([], True) and not truncated and \
+            {result['template_id']: result['outcomes'] for result in results}.get(i, []) == \
+                test_case['expected']:
+        print('    with time budget: passed')
+    else:
+        print('    with time budget: failed')
+        all_passed = False
+
+    # Cached reactants, initialized once and then reused
+    cached = reactants_cache.get(reactant_smiles)
+    if reactants_cache.get(reactant_smiles) is cached and \
+            rdchiralRun(rxn, cached) == test_case['expected']:
+        print('    from cache: passed')
+    else:
+        print('    from cache: failed')
+        all_passed = False
+
+# Caps truncate a template with several outcomes
+print('\n# Caps')
+rxn = rdchiralReaction('[C:1]-[OH;D1:2]>>[C:1]=[O:2]')
+reactants = rdchiralReactants('OCC(O)CCCO')
+outcomes = rdchiralRun(rxn, reactants)
+if len(outcomes) == 3 and \
+        [len(rdchiralRun(rxn, reactants, max_outcomes=n)) for n in (1, 2, 3, 4)] == [1, 2, 3, 3] and \
+        set(rdchiralRun(rxn, reactants, max_outcomes=2)) < set(outcomes) and \
+        len(rdchiralRun(rxn, reactants, max_products=1, combine_enantiomers=False)) == 1 and \
+        len(rdchiralRun(rdchiralReaction(rxn.reaction_smarts, max_outcomes=1), reactants)) == 1:
+    print('    max_outcomes and max_products: passed')
+else:
+    print('    max_outcomes and max_products: failed')
+    all_passed = False
+
+# Statistics count the same events the tracer sees, tagged with their template
+print('\n# Statistics')
+smarts = [test_case['smarts'] for test_case in test_cases]
+events = []
+stats = rdchiralStats()
+previous = utils.set_tracer(lambda level, event, **fields: events.append((event, fields)))
+try:
+    for test_case in test_cases:
+        rdchiralRun(rdchiralReaction(test_case['smarts']), rdchiralReactants(test_case['smiles']),
+            stats=stats)
+finally:
+    utils.set_tracer(previous)
+untraced = rdchiralStats()
+for test_case in test_cases:
+    rdchiralRun(rdchiralReaction(test_case['smarts']), rdchiralReactants(test_case['smiles']),
+        stats=untraced)
+rejections = {}
+for (event, fields) in events:
+    if event == 'outcome_rejected':
+        rejections[fields['reason']] = rejections.get(fields['reason'], 0) + 1
+    elif event == 'all_matches_rejected':
+        rejections[event] = rejections.get(event, 0) + 1
+rejected = [fields for (event, fields) in events if event in ('outcome_rejected', 'all_matches_rejected')]
+if rejected and all(fields['template'] in smarts for fields in rejected) and \
+        all(stats.counters.get(reason) == n for (reason, n) in rejections.items()) and \
+        stats.counters['runs'] == len(test_cases) and \
+        stats.counters == untraced.counters and stats.by_template == untraced.by_template:
+    print('    tracer events: passed')
+else:
+    print('    tracer events: failed')
+    all_passed = False
+
+# Cases 16 and 18 share a template whose raw matches are all rejected, and merging
+# the statistics of two halves of the cases gives the same summary
+template = test_cases[15]['smarts']
+summary = stats.rejection_summary()
+merged = rdchiralStats()
+for test_case in test_cases[:20]:
+    rdchiralRun(rdchiralReaction(test_case['smarts']), rdchiralReactants(test_case['smiles']),
+        stats=merged)
+rest = rdchiralStats()
+for test_case in test_cases[20:]:
+    rdchiralRun(rdchiralReaction(test_case['smarts']), rdchiralReactants(test_case['smiles']),
+        stats=rest)
+merged.merge(rest)
+if test_cases[17]['smarts'] == template and \
+        stats.by_template[template] == {'runs': 2, 'raw_outcomes': 0, 'all_matches_rejected': 2,
+            'outcomes': 0} and \
+        summary[0] == {'template': template, 'runs': 2, 'raw_outcomes': 0, 'outcomes': 0,
+            'rejected': 2, 'reasons': {'all_matches_rejected': 2}} and \
+        len(summary) == len(set(fields['template'] for fields in rejected)) and \
+        stats.rejection_summary(top=1) == summary[:1] and \
+        merged.rejection_summary() == summary:
+    print('    rejection summary: passed')
+else:
+    print('    rejection summary: failed')
+    all_passed = False
+
+# Saved pre-screen index and parallel expansion give the same results
+print('\n# Template library')
+smiles = [test_case['smiles'] for test_case in test_cases]
+expected = [library.expand(smi) for smi in smiles]
+with tempfile.TemporaryDirectory() as tmp:
+    index_path = os.path.join(tmp, 'index.json')
+    library.save_index(index_path)
+    loaded = TemplateLibrary(smarts, index_path=index_path)
+    try:
+        TemplateLibrary(smarts[:5], index_path=index_path)
+        mismatch_rejected = False
+    except ValueError:
+        mismatch_rejected = True
+if loaded.query_fps == library.query_fps and mismatch_rejected and \
+        [loaded.expand(smi) for smi in smiles] == expected:
+    print('    from saved index: passed')
+else:
+    print('    from saved index: failed')
+    all_passed = False
+with tempfile.TemporaryDirectory() as tmp:
+    cache_path = os.path.join(tmp, 'templates.cache')
+    write_template_cache(cache_path, [rdchiralReaction(sma) for sma in smarts])
+    with TemplateStore(cache_path) as store:
+        stored = TemplateLibrary.from_store(store)
+        stored.build_index()
+        index_loads = len(store._reactions)
+        if index_loads == 0 and stored.query_fps == library.query_fps and \
+                [stored.expand(smi) for smi in smiles] == expected:
+            print('    from template store: passed')
+        else:
+            print('    from template store: failed')
+            all_passed = False
+if list(library.expand_many(smiles, processes=2)) == expected:
+    print('    from worker processes: passed')
+else:
+    print('    from worker processes: failed')
+    all_passed = False
+
+# Cache statistics, and atom maps follow the canonical SMILES
+print('\n# Reactants cache')
+stats = reactants_cache.stats()
+cache = rdchiralReactantsCache()
+rxn = rdchiralReaction('[C:1]-[OH;D1:2]>>[C:1]=[O:2]')
+if stats['size'] == 4 and stats['hits'] >= len(test_cases) and \
+        stats['evictions'] == stats['misses'] - 4 and \
+        cache.get('OCC') is cache.get('CCO') and (cache.hits, cache.misses) == (1, 1) and \
+        rdchiralRun(rxn, cache.get('OCC'), return_mapped=True) == \
+            rdchiralRun(rxn, rdchiralReactants('CCO'), return_mapped=True):
+    print('    statistics and mapping: passed')
+else:
+    print('    statistics and mapping: failed')
+    all_passed = False
+
+# Extracted templates give back the reactants of the reaction they came from
+round_trips = [
+    # acyclic stereocenters next to each other (epoxide from a diol)
+    ('O[C@@H:7]([c:6]1[cH:1][cH:2][cH:3][cH:4][cH:5]1)[C@H:8]([OH:9])[c:10]1[cH:11][cH:12][cH:13][cH:14][cH:15]1>>'
+     '[cH:1]1[cH:2][cH:3][cH:4][cH:5][c:6]1[C@H:7]1[C@@H:8]([c:10]2[cH:11][cH:12][cH:13][cH:14][cH:15]2)[O:9]1',
+     'c1ccc([C@H]2O[C@H]2c2ccccc2)cc1', 'O[C@H](c1ccccc1)[C@@H](O)c1ccccc1'),
+    # 1,4-disubstituted cyclohexane with only one of the two centers in the template
+    ('O[C@H:9]1[CH2:8][CH2:7][C@@H:6]([C:4]([O:3][CH2:2][CH3:1])=[O:5])[CH2:18][CH2:17]1.'
+     '[OH:10][CH:11]1[CH2:12][CH2:13][NH:14][CH2:15][CH2:16]1>>'
+     '[CH3:1][CH2:2][O:3][C:4](=[O:5])[C@H:6]1[CH2:7][CH2:8][C@@H:9]([O:10][CH:11]2[CH2:12][CH2:13][NH:14][CH2:15][CH2:16]2)[CH2:17][CH2:18]1',
+     'CCOC(=O)[C@@H]1CC[C@H](OC2CCNCC2)CC1', 'CCOC(=O)[C@H]1CC[C@@H](O)CC1.OC1CCNCC1'),
+]
+print('\n# Template extraction')
+for j, (reaction_smiles, product_smiles, reactant_smiles) in enumerate(round_trips):
+    reactants, products = reaction_smiles.split('>>')
+    template = extract_from_reaction({'_id': j, 'reactants': reactants, 'products': products})
+    if reactant_smiles in rdchiralRunText(template['reaction_smarts'], product_smiles):
+        print('    round trip {}: passed'.format(j+1))
+    else:
+        print('    round trip {}: failed'.format(j+1))
+        all_passed = False
+
+# Registered special groups are found, also when they use 'h' (implicit hydrogens)
+n_groups = len(SPECIAL_GROUPS)
+try:
+    register_special_group('[Sh]C', (0,))
+    register_special_group('[O,Sh]C', (0,))
+    registered = SPECIAL_GROUPS[n_groups:]
+    found = [match for (_, match) in get_special_groups(Chem.MolFromSmiles('CS'))]
+finally:
+    del SPECIAL_GROUPS[n_groups:]
+if [required for (_, _, _, required) in registered] == [({16}, {6}), ({8, 16}, {6})] and \
+        found.count((1, 0)) == 2:
+    print('    registered special group: passed')
+else:
+    print('    registered special group: failed')
+    all_passed = False
+
+# An interrupted extraction resumes where it stopped, and refuses truncated outputs
+rows = [json.dumps({'reaction_smiles': reaction_smiles}) + '\n'
+    for (reaction_smiles, _, _) in round_trips] + ['{"reaction_smiles": "C1CC>>CC"}\n'] + \
+    [json.dumps({'reaction_smiles': reaction_smiles}) + '\n' for (reaction_smiles, _, _) in round_trips]
+def read_text(path):
+    with open(path, 'r') as fid:
+        return fid.read()
+with tempfile.TemporaryDirectory() as tmp:
+    input_path = os.path.join(tmp, 'reactions.jsonl')
+    with open(input_path, 'w') as fid:
+        fid.writelines(rows)
+    uninterrupted_path = os.path.join(tmp, 'uninterrupted.jsonl')
+    uninterrupted = extract_templates(input_path, uninterrupted_path, processes=1, chunksize=1)
+    # stop after the first three rows by running on a shorter file first
+    with open(input_path, 'w') as fid:
+        fid.writelines(rows[:3])
+    templates_path = os.path.join(tmp, 'templates.jsonl')
+    reactions_path = os.path.join(tmp, 'parsable.jsonl')
+    extract_templates(input_path, templates_path, reactions_path, processes=1, chunksize=1)
+    with open(input_path, 'w') as fid:
+        fid.writelines(rows)
+    resumed = extract_templates(input_path, templates_path, reactions_path, processes=1, chunksize=1)
+    resumed_ok = resumed == uninterrupted == {'rows': 5, 'parsable': 4, 'templates': 4} and \
+        read_text(templates_path) == read_text(uninterrupted_path) and \
+        len(read_text(reactions_path).splitlines()) == 4
+    with open(templates_path, 'r+') as fid:
+        fid.truncate(os.path.getsize(templates_path) - 1)
+    try:
+        extract_templates(input_path, templates_path, reactions_path, processes=1, chunksize=1)
+        truncated_rejected = False
+    except ValueError:
+        truncated_rejected = True
+if resumed_ok and truncated_rejected:
+    print('    resumed extraction: passed')
+else:
+    print('    resumed extraction: failed')
+    all_passed = False
+
 all_passed = 'All passed!' if all_passed else 'Failed!'
 print('\n# Final result: {}'.format(all_passed))
\ No newline at end of file